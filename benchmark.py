@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks de las rutas de consulta del bot sobre datos sintéticos.
+
+Genera exportaciones con la misma forma que detalle_calificaciones.csv (de 1k a
+1M filas), ejecuta los handlers reales con Update falsos y un cliente de OpenAI
+simulado, y reporta percentiles de latencia y memoria pico por escenario.
+
+    python benchmark.py                              # 1k, 10k y 100k filas
+    python benchmark.py --filas 1000,1000000 --iteraciones 500
+    python benchmark.py --guardar-base benchmark_base.json
+    python benchmark.py --base benchmark_base.json   # sale con 1 si hay regresiones
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+# El bot lee su configuración al importarse: todo lo persistente va a un directorio temporal
+DIRECTORIO = tempfile.mkdtemp(prefix="bench_bot_")
+os.environ.update({
+    "TELEGRAM_TOKEN": "0:bench",
+    "OPENAI_API_KEY": "",
+    "MEMORY_BACKEND": "json",
+    "MEMORY_FILE": os.path.join(DIRECTORIO, "memory.json"),
+    "MEMORY_DB": os.path.join(DIRECTORIO, "memory.db"),
+    "CSV_SNAPSHOT": "0",
+    "CSV_POLL_INTERVAL": "0",
+    "RATE_LIMIT_PER_MINUTE": "0",
+    "RESPONSE_CACHE_SIZE": "0",
+    "OPENAI_STREAM": "0",
+    "OPENAI_TOOLS": "0",
+})
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import pandas as pd
+
+import bot
+
+# ─── GENERADOR DE DATOS SINTÉTICOS ───────────────────────────────
+CARRERAS = [
+    ("ITI2018", "Ingeniería en Tecnologías de la Información  2018", "ITI"),
+    ("IM2018", "Ingeniería Mecatrónica 2018", "IM"),
+    ("ISA2018", "Ingeniería en Sistemas Automotrices 2018", "ISA"),
+    ("LAGE2018", "Licenciatura en Administración y Gestión Empresarial 2018", "LAGE"),
+    ("IBT2018", "Ingeniería en Biotecnología 2018", "IBT"),
+    ("IF2018", "Ingeniería Financiera 2018", "IF"),
+]
+MATERIAS = [
+    "Ética Profesional", "Inglés", "Matemáticas para Ingeniería", "Programación",
+    "Bases de Datos", "Redes", "Física", "Química", "Cálculo Diferencial",
+    "Cálculo Integral", "Probabilidad y Estadística", "Habilidades Gerenciales",
+    "Expresión Oral y Escrita", "Sistemas Operativos", "Estructura de Datos",
+    "Contabilidad", "Electrónica", "Termodinámica", "Administración de Proyectos",
+    "Habilidades Cognitivas y Creatividad",
+]
+NOMBRES = [
+    "JOSE", "LUIS", "MARIA", "ANA", "JUAN", "CARLOS", "LAURA", "SOFIA", "DIEGO",
+    "FERNANDA", "MIGUEL", "VALERIA", "JORGE", "DANIELA", "RICARDO", "PAOLA",
+    "ALEJANDRO", "GABRIELA", "ISMAEL", "AARON", "ANGEL", "ITZEL", "OMAR", "KARLA",
+]
+APELLIDOS = [
+    "GARCIA", "HERNANDEZ", "LOPEZ", "MARTINEZ", "GONZALEZ", "RODRIGUEZ", "PEREZ",
+    "SANCHEZ", "RAMIREZ", "CRUZ", "FLORES", "GOMEZ", "MORALES", "VAZQUEZ",
+    "REYES", "JIMENEZ", "TORRES", "DIAZ", "GUTIERREZ", "RUIZ", "MENDOZA",
+    "AGUILAR", "ORTIZ", "MORENO", "CASTILLO", "ROMERO", "ALVAREZ", "CASTOR",
+    "SALINAS", "ROCHA", "MURILLO", "CALZADA", "VERA", "CORONADO", "ITUARTE",
+]
+MATERIAS_POR_ALUMNO = 7
+
+def generar_csv(path, filas, semilla=0):
+    """Exportación sintética de `filas` registros con las columnas del CSV real (latin1)."""
+    rng = np.random.default_rng(semilla)
+    alumnos = max(1, filas // MATERIAS_POR_ALUMNO)
+    alumno = np.arange(filas) % alumnos
+    matriculas = 23000000 + np.arange(alumnos)
+    nombres = np.array([
+        f"{a} {b}" if i % 3 else a
+        for i, (a, b) in enumerate(zip(rng.choice(NOMBRES, alumnos), rng.choice(NOMBRES, alumnos)))
+    ])
+    paternos = rng.choice(APELLIDOS, alumnos)
+    maternos = rng.choice(APELLIDOS, alumnos)
+    carrera = rng.integers(len(CARRERAS), size=alumnos)
+    cuatrimestre = rng.integers(1, 11, size=alumnos)
+
+    materias = [f"{m} {n}" if n else m for n in ("", "I", "II", "III", "IV", "V") for m in MATERIAS]
+    materia = rng.integers(len(materias), size=filas)
+    profesores = [
+        f"{rng.choice(NOMBRES)} {rng.choice(APELLIDOS)} {rng.choice(APELLIDOS)}"
+        for _ in range(max(20, filas // 2000))
+    ]
+    # Cada materia la imparte un puñado fijo de profesores
+    profesor_de = rng.integers(len(profesores), size=(len(materias), 3))
+    profesor = profesor_de[materia, rng.integers(3, size=filas)]
+    calificacion = rng.choice([5, 6, 7, 8, 9, 10], size=filas, p=[.04, .06, .15, .3, .3, .15])
+
+    carrera_f = carrera[alumno]
+    df = pd.DataFrame({
+        "Carrera": [f"{CARRERAS[c][0]} {CARRERAS[c][1]}" for c in carrera_f],
+        "Matricula": matriculas[alumno],
+        "Nombre": nombres[alumno],
+        "Paterno": paternos[alumno],
+        "Materno": maternos[alumno],
+        "Materia Clave": [f"M{m:03d}-{c}" for m, c in zip(materia, cuatrimestre[alumno])],
+        "Materia": np.array(materias)[materia],
+        "Calificacion": calificacion,
+        "Cuatrimestre": cuatrimestre[alumno],
+        "Profesor": np.array(profesores)[profesor],
+        "Programa Clave": [f"{CARRERAS[c][2]} {q}MA" for c, q in zip(carrera_f, cuatrimestre[alumno])],
+        "Género": rng.choice(["M", "F"], size=alumnos)[alumno],
+    })
+    df.to_csv(path, index=False, encoding="latin1")
+    return df
+
+# ─── OBJETOS FALSOS DE TELEGRAM Y OPENAI ─────────────────────────
+class MensajeFalso:
+    def __init__(self, texto, user_id):
+        self.text = texto
+        self.from_user = SimpleNamespace(id=user_id)
+
+    async def reply_text(self, texto, **kwargs):
+        return self
+
+    async def edit_text(self, texto, **kwargs):
+        return self
+
+class ConsultaFalsa:
+    def __init__(self, data, user_id):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = None
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, texto, **kwargs):
+        pass
+
+def update_mensaje(texto, user_id=1):
+    mensaje = MensajeFalso(texto, user_id)
+    return SimpleNamespace(message=mensaje, callback_query=None,
+                           effective_user=mensaje.from_user, effective_message=mensaje)
+
+def update_callback(data, user_id=1):
+    consulta = ConsultaFalsa(data, user_id)
+    return SimpleNamespace(message=None, callback_query=consulta,
+                           effective_user=consulta.from_user, effective_message=None)
+
+def contexto():
+    return SimpleNamespace(user_data={}, bot_data={}, args=[])
+
+class CompletadoFalso:
+    """chat.completions con respuesta fija e instantánea (sólo mide el bot)."""
+    async def create(self, **kwargs):
+        contenido = "{}" if kwargs.get("response_format") else "Respuesta simulada."
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=contenido, tool_calls=None),
+                                     finish_reason="stop")],
+            usage=SimpleNamespace(prompt_tokens=0, completion_tokens=0, total_tokens=0),
+        )
+
+CLIENTE_FALSO = SimpleNamespace(chat=SimpleNamespace(completions=CompletadoFalso()))
+
+# ─── ESCENARIOS ──────────────────────────────────────────────────
+def escenarios(df, rng):
+    """nombre -> fábrica de corrutinas; cada llamada es una iteración."""
+    alumnos = df.drop_duplicates("Matricula")
+    matriculas = alumnos["Matricula"].astype(str).tolist()
+    nombres = (alumnos["Nombre"] + " " + alumnos["Paterno"] + " " + alumnos["Materno"]).tolist()
+    profesores = df["Profesor"].unique().tolist()
+    contador = iter(range(10 ** 9))
+
+    async def memoria_update():
+        i = next(contador)
+        bot.memory_system.update_conversation(rng.randrange(1000), "user", f"consulta {i}")
+        mat = rng.choice(matriculas)
+        bot.memory_system.update_knowledge("alumnos", mat, {"keywords": [mat, rng.choice(nombres).lower()]})
+
+    async def memoria_save():
+        for _ in range(20):
+            bot.memory_system.update_conversation(rng.randrange(1000), "user", "consulta")
+        bot.memory_system.flush()
+
+    async def memoria_related():
+        bot.memory_system.get_related_knowledge(rng.choice(nombres))
+
+    return {
+        "matricula": lambda: bot.buscar(update_mensaje(rng.choice(matriculas)), contexto()),
+        "nombre": lambda: bot.buscar(update_mensaje(rng.choice(nombres)), contexto()),
+        "profesor": lambda: bot.buscar(update_mensaje(f"profesor {rng.choice(profesores)}"), contexto()),
+        "lista_profesores": lambda: bot.buscar(update_mensaje("lista de profesores"), contexto()),
+        "callback_calificaciones": lambda: bot.callback_handler(
+            update_callback(f"grades|{rng.choice(matriculas)}"), contexto()),
+        "callback_general": lambda: bot.callback_handler(
+            update_callback(f"general|{rng.choice(matriculas)}"), contexto()),
+        "ia": lambda: bot.buscar(
+            update_mensaje(f"explica el rendimiento general {next(contador)}", rng.randrange(1000)),
+            contexto()),
+        "memoria_update": memoria_update,
+        "memoria_save": memoria_save,
+        "memoria_related": memoria_related,
+    }
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+async def medir(fabrica, iteraciones, muestras_memoria):
+    for _ in range(min(10, iteraciones)):
+        await fabrica()
+    tiempos = []
+    for _ in range(iteraciones):
+        inicio = time.perf_counter()
+        await fabrica()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    # Memoria aparte: tracemalloc distorsiona las latencias
+    tracemalloc.start()
+    for _ in range(muestras_memoria):
+        await fabrica()
+    pico = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "n": iteraciones,
+        "media_ms": statistics.fmean(tiempos),
+        "p50_ms": percentil(tiempos, 50),
+        "p95_ms": percentil(tiempos, 95),
+        "p99_ms": percentil(tiempos, 99),
+        "max_ms": max(tiempos),
+        "pico_kb": pico / 1024,
+    }
+
+async def correr_tamano(filas, args):
+    path = os.path.join(DIRECTORIO, f"sintetico_{filas}.csv")
+    df = generar_csv(path, filas, semilla=args.semilla)
+
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    bot.CSV_PATH = path
+    bot.inicializar()
+    carga = {"n": 1, "media_ms": (time.perf_counter() - inicio) * 1000,
+             "pico_kb": tracemalloc.get_traced_memory()[1] / 1024}
+    tracemalloc.stop()
+    carga.update(p50_ms=carga["media_ms"], p95_ms=carga["media_ms"],
+                 p99_ms=carga["media_ms"], max_ms=carga["media_ms"])
+    bot.memory_system.close()
+    bot.memory_system = bot.MemorySystem(
+        store=bot.JsonMemoryStore(os.path.join(DIRECTORIO, f"memory_{filas}.json"))
+    )
+    bot.client = CLIENTE_FALSO
+
+    resultados = {"carga_datos": carga}
+    rng = random.Random(args.semilla)
+    for nombre, fabrica in escenarios(df, rng).items():
+        if args.escenarios and nombre not in args.escenarios:
+            continue
+        resultados[nombre] = await medir(fabrica, args.iteraciones, args.muestras_memoria)
+    bot.memory_system.close()
+    return resultados
+
+async def correr(args):
+    actual = {}
+    for filas in (int(f) for f in args.filas.split(",")):
+        resultados = await correr_tamano(filas, args)
+        imprimir(filas, resultados)
+        actual[str(filas)] = resultados
+    await bot.extractor.detener()
+    return actual
+
+# ─── REPORTE Y COMPARACIÓN ───────────────────────────────────────
+def imprimir(filas, resultados):
+    print(f"\n== {filas:,} filas ==")
+    print(f"{'escenario':<24}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'pico KB':>12}")
+    for nombre, r in resultados.items():
+        print(f"{nombre:<24}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}{r['p99_ms']:>10.3f}"
+              f"{r['max_ms']:>10.3f}{r['pico_kb']:>12.1f}")
+
+def comparar(actual, base, tolerancia):
+    """Lista de regresiones: p95 (o memoria pico) más de `tolerancia` veces la base."""
+    regresiones = []
+    for filas, escenarios_base in base.get("resultados", {}).items():
+        for nombre, b in escenarios_base.items():
+            r = actual.get(filas, {}).get(nombre)
+            if r is None:
+                continue
+            for metrica in ("p95_ms", "pico_kb"):
+                # Umbral mínimo para no marcar ruido en mediciones de microsegundos
+                piso = 1.0 if metrica == "p95_ms" else 256
+                if r[metrica] > max(b[metrica] * tolerancia, piso):
+                    regresiones.append(
+                        f"{filas} filas / {nombre}: {metrica} {r[metrica]:.3f} vs base {b[metrica]:.3f}"
+                    )
+    return regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--filas", default="1000,10000,100000",
+                        help="Tamaños de dataset separados por comas (hasta 1000000)")
+    parser.add_argument("--iteraciones", type=int, default=200)
+    parser.add_argument("--muestras-memoria", type=int, default=20)
+    parser.add_argument("--escenarios", type=lambda s: set(s.split(",")), default=None,
+                        help="Sólo estos escenarios (separados por comas)")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--salida", help="Guarda los resultados en este JSON")
+    parser.add_argument("--base", help="JSON de una corrida anterior para comparar")
+    parser.add_argument("--guardar-base", help="Guarda esta corrida como base")
+    parser.add_argument("--tolerancia", type=float, default=1.5,
+                        help="Factor sobre la base a partir del cual hay regresión")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    actual = asyncio.run(correr(args))
+
+    reporte = {
+        "fecha": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "rss_pico_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "resultados": actual,
+    }
+    print(f"\nRSS pico del proceso: {reporte['rss_pico_mb']:.1f} MB")
+    for destino in (args.salida, args.guardar_base):
+        if destino:
+            with open(destino, "w", encoding="utf-8") as f:
+                json.dump(reporte, f, indent=2)
+
+    if args.base:
+        with open(args.base, encoding="utf-8") as f:
+            regresiones = comparar(actual, json.load(f), args.tolerancia)
+        if regresiones:
+            print(f"\n❌ {len(regresiones)} regresiones (tolerancia x{args.tolerancia}):")
+            for linea in regresiones:
+                print(f"- {linea}")
+            sys.exit(1)
+        print("\n✅ Sin regresiones respecto de la base.")
+
+if __name__ == "__main__":
+    main()
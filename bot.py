@@ -1,30 +1,115 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from __future__ import annotations
 
 # ─── LIBRERÍAS ────────────────────────────────────────────────────
+import time
+_INICIO_PROCESO = time.perf_counter()
+
 import os
 import re
+import math
 import json
+import pickle
+import hashlib
+import sqlite3
+import tempfile
 import unicodedata
+import atexit
+import threading
+import asyncio
 import logging
-import pandas as pd
-import numpy as np
+import signal
+import socket
+import importlib
+import functools
+import glob
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ProcessPoolExecutor
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import (
     Application, CommandHandler,
     CallbackQueryHandler, MessageHandler,
-    ContextTypes, filters, CallbackContext
+    ContextTypes, filters, CallbackContext,
+    BaseUpdateProcessor
 )
-from openai import OpenAI
+
+class ModuloPerezoso:
+    """Importa el módulo real en el primer acceso a uno de sus atributos."""
+    def __init__(self, nombre):
+        self._nombre = nombre
+        self._modulo = None
+
+    def __getattr__(self, attr):
+        if self._modulo is None:
+            self._modulo = importlib.import_module(self._nombre)
+        return getattr(self._modulo, attr)
+
+# pandas/numpy sólo se importan al cargar datos
+pd = ModuloPerezoso("pandas")
+np = ModuloPerezoso("numpy")
 
 # ─── CONFIGURACIÓN ───────────────────────────────────────────────
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_TOKEN")
+# API de Telegram alternativa (servidor local de pruebas o Bot API propio)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # URL pública para setWebhook (opcional)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", str(1024 * 1024)))  # bytes
+# Procesos del webhook; el orden por usuario y el límite de consultas rigen dentro de cada uno
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "0")) or os.cpu_count() or 1
 CSV_PATH = os.getenv("CSV_PATH")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-MEMORY_FILE = "memory.json"
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo-1106")
+# Endpoint compatible con OpenAI alternativo (proxy, servidor local de pruebas)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+EXTRACTOR_QUEUE_MAX = int(os.getenv("EXTRACTOR_QUEUE_MAX", "200"))
+EXTRACTOR_BATCH_SIZE = int(os.getenv("EXTRACTOR_BATCH_SIZE", "5"))
+EXTRACTOR_BATCH_WAIT = float(os.getenv("EXTRACTOR_BATCH_WAIT", "3"))
+CSV_SNAPSHOT = os.getenv("CSV_SNAPSHOT", "1") != "0"
+CSV_POLL_INTERVAL = float(os.getenv("CSV_POLL_INTERVAL", "60"))
+CSV_LOAD_WORKERS = int(os.getenv("CSV_LOAD_WORKERS", "0")) or os.cpu_count() or 1
+STUDENT_VIEW_CACHE_SIZE = int(os.getenv("STUDENT_VIEW_CACHE_SIZE", "5000"))
+ADMIN_IDS = {i.strip() for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()}
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2500"))
+OPENAI_STREAM = os.getenv("OPENAI_STREAM", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+OPENAI_TOOLS = os.getenv("OPENAI_TOOLS", "0") == "1"
+OPENAI_TOOL_ROUNDS = int(os.getenv("OPENAI_TOOL_ROUNDS", "4"))
+CALIFICACION_APROBATORIA = float(os.getenv("CALIFICACION_APROBATORIA", "7"))
+MEMORY_FILE = os.getenv("MEMORY_FILE", "memory.json")
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "json").lower()
+MEMORY_DB = os.getenv("MEMORY_DB", "memory.db")
+MEMORY_CACHE_USERS = int(os.getenv("MEMORY_CACHE_USERS", "1000"))
+MEMORY_WRITE_BEHIND = os.getenv("MEMORY_WRITE_BEHIND", "1") != "0"
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "2"))
+MEMORY_COMPACT_EVERY = int(os.getenv("MEMORY_COMPACT_EVERY", "500"))
+MEMORY_RELATED_MAX = int(os.getenv("MEMORY_RELATED_MAX", "5"))
+# Consultas a la IA por usuario: ráfaga inicial y ritmo sostenido (0 = sin límite)
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "6"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "3"))
+# Endpoint de métricas Prometheus (0 = desactivado); en modo webhook cada worker usa puerto + n
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+# Actualizaciones ejecutándose a la vez (1 = secuencial) y máximo admitidas en el
+# procesador (en curso o esperando su turno); PTB crea igual una tarea por actualización
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "256"))
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -32,9 +117,144 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ─── AYUDANTE: NORMALIZAR TEXTO ─────────────────────────────────
+def quitar_acentos(texto: str) -> str:
+    if not isinstance(texto, str):
+        return texto
+    texto = re.sub(r"[^\w\s]", "", texto)
+    n = unicodedata.normalize("NFD", texto)
+    return "".join(c for c in n if unicodedata.category(c) != "Mn")
+
+def normalizar_consulta(consulta: str) -> str:
+    return " ".join(quitar_acentos(consulta.lower()).split())
+
+def normalizar_columna(serie: pd.Series) -> pd.Series:
+    """Minúsculas y sin acentos; normaliza cada valor distinto una sola vez."""
+    valores = serie.astype(str).str.lower()
+    normalizados = {v: quitar_acentos(v) for v in valores.unique()}
+    return valores.map(normalizados)
+
+# ─── MÉTRICAS ─────────────────────────────────────────────────────
+CUBETAS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def escapar_etiqueta(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metricas:
+    """
+    Contadores, gauges e histogramas con etiquetas, en memoria del proceso,
+    exportables en el formato de texto de Prometheus. El flush de la memoria
+    corre en otro hilo, por eso las escrituras toman `_lock`.
+    """
+    def __init__(self):
+        self.definiciones = {}  # nombre -> (tipo, ayuda, cubetas)
+        self.valores = {}       # nombre -> {etiquetas: valor | [conteos, suma, n]}
+        self._lock = threading.Lock()
+
+    def registrar(self, nombre, tipo, ayuda, cubetas=CUBETAS_SEGUNDOS):
+        self.definiciones[nombre] = (tipo, ayuda, cubetas)
+        self.valores.setdefault(nombre, {})
+
+    def incrementar(self, nombre, valor=1, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            serie = self.valores[nombre]
+            serie[clave] = serie.get(clave, 0) + valor
+
+    def fijar(self, nombre, valor, **etiquetas):
+        with self._lock:
+            self.valores[nombre][tuple(sorted(etiquetas.items()))] = valor
+
+    def observar(self, nombre, valor, **etiquetas):
+        clave = tuple(sorted(etiquetas.items()))
+        cubetas = self.definiciones[nombre][2]
+        with self._lock:
+            serie = self.valores[nombre]
+            if clave not in serie:
+                serie[clave] = [[0] * (len(cubetas) + 1), 0.0, 0]
+            datos_serie = serie[clave]
+            indice = next((i for i, limite in enumerate(cubetas) if valor <= limite), len(cubetas))
+            datos_serie[0][indice] += 1
+            datos_serie[1] += valor
+            datos_serie[2] += 1
+
+    def serie(self, nombre):
+        with self._lock:
+            return {clave: (list(v[0]), v[1], v[2]) if isinstance(v, list) else v
+                    for clave, v in self.valores.get(nombre, {}).items()}
+
+    def cuantil(self, nombre, q, clave):
+        """Estimación del cuantil `q` de un histograma interpolando dentro de la cubeta."""
+        conteos, _, n = self.serie(nombre)[clave]
+        cubetas = self.definiciones[nombre][2]
+        objetivo, acumulado, inferior = q * n, 0, 0.0
+        for conteo, superior in zip(conteos, cubetas + (cubetas[-1],)):
+            if conteo and acumulado + conteo >= objetivo:
+                return inferior + (superior - inferior) * (objetivo - acumulado) / conteo
+            acumulado += conteo
+            inferior = superior
+        return cubetas[-1]
+
+    def exportar(self) -> str:
+        lineas = []
+        for nombre, (tipo, ayuda, cubetas) in self.definiciones.items():
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            for clave, valor in sorted(self.serie(nombre).items()):
+                etiquetas = [f'{k}="{escapar_etiqueta(v)}"' for k, v in clave]
+                if tipo != "histogram":
+                    texto = "{" + ",".join(etiquetas) + "}" if etiquetas else ""
+                    lineas.append(f"{nombre}{texto} {valor:g}")
+                    continue
+                conteos, suma, n = valor
+                acumulado = 0
+                for limite, conteo in zip(cubetas + ("+Inf",), conteos):
+                    acumulado += conteo
+                    le = "{" + ",".join(etiquetas + [f'le="{limite}"']) + "}"
+                    lineas.append(f"{nombre}_bucket{le} {acumulado}")
+                texto = "{" + ",".join(etiquetas) + "}" if etiquetas else ""
+                lineas.append(f"{nombre}_sum{texto} {suma:g}")
+                lineas.append(f"{nombre}_count{texto} {n}")
+        return "\n".join(lineas) + "\n"
+
+metricas = Metricas()
+metricas.registrar("bot_handler_segundos", "histogram", "Duración de cada handler por rama")
+metricas.registrar("bot_consultas_ia_total", "counter", "Consultas de IA por resultado")
+metricas.registrar("openai_llamadas_total", "counter", "Llamadas a la API de OpenAI")
+metricas.registrar("openai_segundos", "histogram", "Duración de las llamadas a OpenAI")
+metricas.registrar("openai_tokens_total", "counter", "Tokens informados por OpenAI")
+metricas.registrar("memoria_guardado_segundos", "histogram", "Duración de cada flush de la memoria")
+metricas.registrar("memoria_archivo_bytes", "gauge", "Tamaño en disco de la memoria")
+metricas.registrar("datos_registros", "gauge", "Registros en los datos activos")
+metricas.registrar("datos_version", "gauge", "Versión de los datos activos")
+metricas.registrar("datos_carga_segundos", "gauge", "Duración de la última carga de datos")
+metricas.registrar("cache_respuestas", "gauge", "Estado de la caché de respuestas de IA")
+metricas.registrar("consultas_compartidas_total", "counter", "Consultas de IA unidas a una llamada en curso")
+metricas.registrar("consultas_limitadas_total", "counter", "Consultas de IA rechazadas por el límite por usuario")
+metricas.registrar("extractor_cola", "gauge", "Interacciones pendientes de extracción de conocimiento")
+
+def instrumentado(nombre):
+    """
+    Mide la duración de un handler. La rama es el texto que devuelve el
+    handler ("matricula", "ia", ...) o "error" si lanza una excepción.
+    """
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        async def envoltura(update, context):
+            inicio = time.perf_counter()
+            rama = "error"
+            try:
+                rama = await funcion(update, context) or "otro"
+            finally:
+                metricas.observar("bot_handler_segundos", time.perf_counter() - inicio,
+                                  handler=nombre, rama=rama)
+        return envoltura
+    return decorador
+
 # ─── CARGA Y PREPARACIÓN DE DATOS ────────────────────────────────
-try:
-    df = pd.read_csv(CSV_PATH, encoding="latin1")
+def preparar_csv(path) -> pd.DataFrame:
+    """Lee el CSV de calificaciones y agrega las columnas derivadas."""
+    df = pd.read_csv(path, encoding="latin1")
     logger.info("CSV cargado. Columnas: %s", df.columns.tolist())
     
     # Preprocesamiento para análisis
@@ -44,160 +264,1998 @@ try:
     df['Calificacion'] = pd.to_numeric(df['Calificacion'], errors='coerce')
     
     # Crear versión normalizada para búsquedas
-    df['Busqueda'] = df['Nombre_Completo'].apply(lambda x: re.sub(r'[^\w\s]', '', x.lower()))
-    df['Profesor_Norm'] = df['Profesor'].apply(lambda x: re.sub(r'[^\w\s]', '', str(x).lower()))
+    df['Nombre_Norm'] = normalizar_columna(df['Nombre'])
+    df['Paterno_Norm'] = normalizar_columna(df['Paterno'])
+    df['Materno_Norm'] = normalizar_columna(df['Materno'])
     
     # Agregar promedio general por alumno
     promedios = df.groupby('Matricula')['Calificacion'].mean().reset_index()
     promedios.columns = ['Matricula', 'Promedio_General']
     df = pd.merge(df, promedios, on='Matricula', how='left')
     
-    # Preparar datos de profesores (CORRECCIÓN: USAR SOLO DATOS DE PROFESORES)
-    profesores_df = df.groupby('Profesor').agg({
-        'Materia': 'nunique',
-        'Calificacion': 'mean'
-    }).reset_index()
-    profesores_df.columns = ['Profesor', 'Materias_Impartidas', 'Promedio_Calificaciones']
-    
-    logger.info("Datos preparados para análisis IA. %d registros", len(df))
-    
-except Exception as e:
-    logger.error("Error al leer/preparar CSV: %s", e)
-    df = pd.DataFrame()
-    profesores_df = pd.DataFrame()
+    df = compactar(df)
+    logger.info(
+        "Datos preparados para análisis IA. %d registros, %.1f MB",
+        len(df), df.memory_usage(deep=True).sum() / 1e6
+    )
+    return df
+
+def compactar(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Representación compacta: los textos (muy repetidos) pasan a categorías y
+    los números a los tipos más angostos que los contienen.
+    """
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype("category")
+    for col in ("Matricula", "Cuatrimestre"):
+        if col in df.columns and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+    for col in ("Calificacion", "Promedio_General"):
+        if col in df.columns:
+            df[col] = df[col].astype("float32")
+    return df
+
+# ─── INSTANTÁNEA BINARIA DEL CSV ─────────────────────────────────
+FORMATO_SNAPSHOT = 2
+
+def ruta_snapshot(path) -> str:
+    return f"{path}.snapshot.pkl"
+
+def huella_archivo(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+def leer_snapshot(path, huella):
+    """DataFrame ya preparado si la instantánea corresponde a este CSV; si no, None."""
+    try:
+        with open(ruta_snapshot(path), "rb") as f:
+            snapshot = pickle.load(f)
+        if snapshot.get("formato") == FORMATO_SNAPSHOT and snapshot.get("huella") == huella:
+            return snapshot["df"]
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("Instantánea de datos inválida, se relee el CSV: %s", e)
+    return None
+
+def guardar_snapshot(path, huella, df):
+    destino = ruta_snapshot(path)
+    tmp_path = None
+    try:
+        # Temporal propio: varios workers pueden guardar la misma instantánea a la vez
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(destino) + ".",
+                                        suffix=".tmp", dir=os.path.dirname(destino) or ".")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump({"formato": FORMATO_SNAPSHOT, "huella": huella, "df": df}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, destino)
+    except Exception as e:
+        logger.warning("No se pudo guardar la instantánea de datos: %s", e)
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def cargar_csv(path) -> pd.DataFrame:
+    """
+    Datos preparados del CSV. Si existe una instantánea binaria con la misma
+    huella (SHA-256) del CSV se usa directamente; si no, se procesa el CSV y
+    se guarda la instantánea junto a él.
+    """
+    if not CSV_SNAPSHOT:
+        return preparar_csv(path)
+    huella = huella_archivo(path)
+    df = leer_snapshot(path, huella)
+    if df is not None:
+        logger.info("Datos cargados de la instantánea %s. %d registros", ruta_snapshot(path), len(df))
+        return df
+    df = preparar_csv(path)
+    guardar_snapshot(path, huella, df)
+    return df
+
+# ─── VARIAS EXPORTACIONES (PARTICIONES) ──────────────────────────
+def fuentes_csv(spec) -> list:
+    """
+    Lista de (clave, ruta) a partir de CSV_PATH: rutas o patrones glob separados
+    por comas o por os.pathsep. Cada elemento acepta una clave explícita
+    ("norte-2024=/datos/norte.csv"); si no, la clave es el nombre del archivo
+    sin extensión. Una misma ruta sólo se toma una vez.
+    """
+    fuentes, vistas, claves = [], set(), set()
+    for elemento in re.split(rf"[,{re.escape(os.pathsep)}]", spec or ""):
+        elemento = elemento.strip()
+        if not elemento:
+            continue
+        clave, sep, patron = elemento.partition("=")
+        if not sep:
+            clave, patron = "", elemento
+        rutas = sorted(glob.glob(patron)) if glob.has_magic(patron) else [patron]
+        for ruta in rutas:
+            real = os.path.realpath(ruta)
+            if real in vistas:
+                continue
+            vistas.add(real)
+            base = clave.strip() or os.path.splitext(os.path.basename(ruta))[0]
+            nombre, n = base, 2
+            while nombre in claves:
+                nombre, n = f"{base}-{n}", n + 1
+            claves.add(nombre)
+            fuentes.append((nombre, ruta))
+    return fuentes
+
+def cargar_particiones(fuentes, estricto=False) -> dict:
+    """
+    clave -> DataFrame preparado de cada exportación. Con varias fuentes se
+    procesan en paralelo en un pool de procesos (CSV_LOAD_WORKERS), así que el
+    tiempo de carga depende de los núcleos y no del número de archivos. Una
+    fuente que falla (o viene vacía) se omite sin descartar las demás, salvo con
+    `estricto`, donde cualquier falla lanza ValueError.
+    """
+    particiones, fallidas = {}, []
+
+    def recibir(clave, ruta, obtener):
+        try:
+            df = obtener()
+            if df.empty:
+                raise ValueError("sin registros")
+            particiones[clave] = df
+        except Exception as e:
+            logger.error("Error al leer/preparar %s: %s", ruta, e)
+            fallidas.append(f"{ruta}: {e}")
+
+    trabajadores = min(len(fuentes), CSV_LOAD_WORKERS)
+    if trabajadores > 1:
+        # "spawn": no se hace fork de un proceso que ya tiene hilos activos
+        contexto = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=trabajadores, mp_context=contexto) as pool:
+            futuros = {clave: (ruta, pool.submit(cargar_csv, ruta)) for clave, ruta in fuentes}
+            for clave, (ruta, futuro) in futuros.items():
+                recibir(clave, ruta, futuro.result)
+    else:
+        for clave, ruta in fuentes:
+            recibir(clave, ruta, lambda: cargar_csv(ruta))
+    if estricto and fallidas:
+        raise ValueError("fuentes con error: " + "; ".join(fallidas))
+    return particiones
+
+def combinar_particiones(particiones: dict) -> pd.DataFrame:
+    """
+    Une las particiones en un solo DataFrame con la columna `Fuente`. Los
+    registros repetidos entre exportaciones (p. ej. un archivo y su "- copia")
+    se conservan sólo en la primera fuente que los trae, y el promedio general
+    se recalcula sobre el conjunto ya unido.
+    """
+    if not particiones:
+        return pd.DataFrame()
+    marcos = [df.assign(Fuente=clave) for clave, df in particiones.items()]
+    if len(marcos) == 1:
+        return compactar(marcos[0])
+    df = pd.concat(marcos, ignore_index=True)
+    columnas = [c for c in df.columns if c not in ("Fuente", "Promedio_General")]
+    repetidos = df.duplicated(subset=columnas)
+    if repetidos.any():
+        logger.info("Se descartan %d registros repetidos entre fuentes", int(repetidos.sum()))
+        df = df[~repetidos].reset_index(drop=True)
+    df["Promedio_General"] = (
+        df["Calificacion"].astype("float64").groupby(df["Matricula"]).transform("mean")
+    )
+    df = compactar(df)
+    logger.info(
+        "Fuentes combinadas: %s",
+        ", ".join(f"{clave} ({n})" for clave, n in df["Fuente"].value_counts(sort=False).items())
+    )
+    return df
+
+def cargar_fuentes(fuentes, estricto=False) -> pd.DataFrame:
+    """Carga y une las fuentes; con `estricto` una falla o un resultado vacío lanza ValueError."""
+    df = combinar_particiones(cargar_particiones(fuentes, estricto))
+    if estricto and df.empty:
+        raise ValueError("las fuentes no contienen registros")
+    return df
+
+# ─── ÍNDICE DE MATRÍCULAS ────────────────────────────────────────
+def normalizar_matricula(valor) -> str:
+    return str(valor).strip()
+
+def construir_indice_matriculas(datos: pd.DataFrame) -> dict:
+    """Mapea cada matrícula normalizada a las posiciones (iloc) de sus registros."""
+    if datos.empty or "Matricula" not in datos.columns:
+        return {}
+    claves = datos["Matricula"].astype(str).str.strip()
+    return dict(claves.groupby(claves, sort=False).indices)
+
+# ─── ÍNDICE DE NOMBRES ───────────────────────────────────────────
+CAMPOS_NOMBRE = ("Nombre_Norm", "Paterno_Norm", "Materno_Norm")
+TAM_NGRAMA = 3
+
+def ngramas(texto: str) -> set:
+    return {texto[i:i + TAM_NGRAMA] for i in range(len(texto) - TAM_NGRAMA + 1)}
+
+def construir_indice_nombres(datos: pd.DataFrame) -> dict:
+    """
+    Índice invertido de trigramas sobre Nombre/Paterno/Materno normalizados.
+    Sólo indexa la primera fila de cada combinación de nombre distinta, que es
+    la que devolvería un filtro secuencial sobre todo el DataFrame.
+    """
+    if datos.empty or not set(CAMPOS_NOMBRE).issubset(datos.columns):
+        return {"posiciones": [], "valores": {}, "postings": {}}
+    nombres = datos[list(CAMPOS_NOMBRE)]
+    posiciones = np.flatnonzero(~nombres.duplicated().to_numpy()).tolist()
+    valores = {}
+    postings = {}
+    for campo in CAMPOS_NOMBRE:
+        columna = nombres[campo].to_numpy()
+        valores[campo] = {pos: columna[pos] for pos in posiciones}
+        por_ngrama = {}
+        for pos, valor in valores[campo].items():
+            for ng in ngramas(valor):
+                por_ngrama.setdefault(ng, set()).add(pos)
+        postings[campo] = por_ngrama
+    return {"posiciones": posiciones, "valores": valores, "postings": postings}
+
+# ─── PERFILES DE PROFESORES ──────────────────────────────────────
+def normalizar_profesor(nombre) -> str:
+    return " ".join(quitar_acentos(str(nombre).lower()).split())
+
+def construir_perfiles_profesores(datos: pd.DataFrame) -> dict:
+    """
+    Perfil precalculado por profesor, indexado por su nombre normalizado:
+    materias, carreras y cuatrimestres (en orden de aparición), promedio de
+    calificaciones y cantidad de alumnos distintos.
+    """
+    if datos.empty or "Profesor" not in datos.columns:
+        return {}
+    grupos = datos.groupby("Profesor", sort=True, observed=True)
+    materias = grupos["Materia"].unique()
+    carreras = grupos["Carrera"].unique()
+    cuatrimestres = grupos["Cuatrimestre"].unique()
+    promedios = grupos["Calificacion"].mean()
+    alumnos = grupos["Matricula"].nunique()
+
+    perfiles = {}
+    for profesor in promedios.index:
+        perfiles[normalizar_profesor(profesor)] = {
+            "Profesor": profesor,
+            "Materias": materias[profesor].tolist(),
+            "Carreras": carreras[profesor].tolist(),
+            "Cuatrimestres": cuatrimestres[profesor].tolist(),
+            "Promedio_Calificaciones": float(promedios[profesor]),
+            "Cantidad_Alumnos": int(alumnos[profesor]),
+        }
+    return perfiles
+
+# ─── PERFIL DEL DATASET ──────────────────────────────────────────
+def construir_perfil_dataset(datos: pd.DataFrame, version: int) -> dict:
+    """
+    Estadísticas del dataset calculadas una sola vez por versión de los datos:
+    conteos, rango de calificaciones y métricas por carrera y por fuente.
+    `resumen` es el texto listo para el prompt.
+    """
+    if datos.empty:
+        return {"version": version, "registros": 0, "resumen": "Dataset vacío."}
+    cal = datos["Calificacion"]
+    por_carrera = datos.groupby("Carrera", observed=True).agg(
+        Registros=("Calificacion", "size"),
+        Alumnos=("Matricula", "nunique"),
+        Promedio=("Calificacion", "mean"),
+    )
+    perfil = {
+        "version": version,
+        "registros": len(datos),
+        "carreras": int(datos["Carrera"].nunique()),
+        "materias": int(datos["Materia"].nunique()),
+        "profesores": int(datos["Profesor"].nunique()),
+        "alumnos": int(datos["Matricula"].nunique()),
+        "calificacion_min": float(cal.min()),
+        "calificacion_max": float(cal.max()),
+        "calificacion_promedio": float(cal.mean()),
+        "por_carrera": por_carrera.to_dict("index"),
+        "por_fuente": {
+            str(k): int(v) for k, v in datos["Fuente"].value_counts(sort=False).items()
+        } if "Fuente" in datos.columns else {},
+    }
+    lineas_carrera = "\n".join(
+        f"- {carrera}: {fila['Alumnos']} alumnos, promedio {fila['Promedio']:.2f}"
+        for carrera, fila in perfil["por_carrera"].items()
+    )
+    perfil["resumen"] = (
+        f"Dataset con {perfil['registros']} registros. "
+        f"Carreras: {perfil['carreras']}, "
+        f"Materias: {perfil['materias']}, "
+        f"Profesores: {perfil['profesores']}, "
+        f"Alumnos: {perfil['alumnos']}. "
+        f"Calificaciones: Min {perfil['calificacion_min']:.1f}, "
+        f"Max {perfil['calificacion_max']:.1f}, "
+        f"Avg {perfil['calificacion_promedio']:.1f}.\n"
+        f"Por carrera:\n{lineas_carrera}"
+    )
+    if len(perfil["por_fuente"]) > 1:
+        perfil["resumen"] += "\nFuentes: " + ", ".join(
+            f"{fuente} ({n} registros)" for fuente, n in perfil["por_fuente"].items()
+        )
+    return perfil
+
+# ─── VOCABULARIO DE ENTIDADES ────────────────────────────────────
+COLUMNAS_ENTIDAD = ("Materia", "Profesor", "Carrera", "Fuente")
+
+def construir_vocabulario(datos: pd.DataFrame) -> dict:
+    """
+    Nombre normalizado -> valor original de cada materia, profesor, carrera y
+    fuente (exportación).
+    Las carreras también se reconocen por su clave ("iti2018") y sus letras ("iti").
+    """
+    vocabulario = {col: {} for col in COLUMNAS_ENTIDAD}
+    if datos.empty:
+        return vocabulario
+    for col in COLUMNAS_ENTIDAD:
+        for valor in datos[col].dropna().unique():
+            norm = normalizar_consulta(str(valor))
+            if len(norm) >= 3:
+                vocabulario[col][norm] = valor
+    for norm, valor in list(vocabulario["Carrera"].items()):
+        clave = norm.split()[0]
+        vocabulario["Carrera"].setdefault(clave, valor)
+        letras = re.match(r"[a-z]+", clave)
+        if letras and len(letras.group()) >= 2:
+            vocabulario["Carrera"].setdefault(letras.group(), valor)
+    return vocabulario
+
+# ─── RENDERIZADO DE ALUMNOS ──────────────────────────────────────
+def teclado_alumno(mat, vista):
+    if vista == "grades":
+        boton = InlineKeyboardButton("👤 Ver datos alumno", callback_data=f"general|{mat}")
+    else:
+        boton = InlineKeyboardButton("📊 Ver calificaciones", callback_data=f"grades|{mat}")
+    return InlineKeyboardMarkup([
+        [boton, InlineKeyboardButton("🔄 Consultar otro", callback_data="back")]
+    ])
+
+def render_resumen_alumno(r, mat) -> str:
+    return (
+        f"👤 *Alumno: {r['Nombre']} {r.get('Paterno','')} {r.get('Materno','')}*\n"
+        f"🎓 Carrera: {r.get('Carrera','N/A')}\n"
+        f"🔢 Matrícula: {mat}\n"
+        f"⭐ Promedio general: {r.get('Promedio_General','N/A'):.2f}\n"
+        f"📅 Cuatrimestre: {r.get('Cuatrimestre','N/A')}"
+    )
+
+def render_calificaciones(sub: pd.DataFrame) -> str:
+    lines = ["📊 *Calificaciones por materia:*"]
+    for matname, cal, profesor in zip(sub["Materia"], sub["Calificacion"], sub["Profesor"]):
+        lines.append(f"- {matname}: {cal} (Prof: {profesor})")
+    return "\n".join(lines)
+
+# ─── DATOS ACTIVOS Y RECARGA ─────────────────────────────────────
+class DatosAcademicos:
+    """
+    Instantánea inmutable del CSV y de todas sus estructuras derivadas.
+    Se construye completa antes de publicarse en `datos`, así que un handler
+    que toma `d = datos` al empezar nunca ve una mezcla de versiones.
+    """
+    def __init__(self, df: pd.DataFrame, version: int, firma=None):
+        self.df = df
+        self.version = version
+        # (clave, ruta, mtime) de cada fuente con la que se construyó
+        self.firma = firma
+        self.indice_matriculas = construir_indice_matriculas(df)
+        self.indice_nombres = construir_indice_nombres(df)
+        self.perfiles_profesores = construir_perfiles_profesores(df)
+        self.perfil_dataset = construir_perfil_dataset(df, version)
+        self.vocabulario = construir_vocabulario(df)
+        # Vistas de alumnos ya renderizadas: (matrícula, vista) -> (texto, teclado)
+        self.vistas = OrderedDict()
+        logger.info(
+            "Datos v%d listos. %d matrículas, %d nombres distintos, %d profesores",
+            version, len(self.indice_matriculas),
+            len(self.indice_nombres["posiciones"]), len(self.perfiles_profesores)
+        )
+
+    def registros_por_matricula(self, mat) -> pd.DataFrame:
+        """Registros de un alumno en O(1) usando el índice de matrículas."""
+        posiciones = self.indice_matriculas.get(normalizar_matricula(mat))
+        if posiciones is None:
+            return self.df.iloc[0:0]
+        return self.df.iloc[posiciones]
+
+    def vista_alumno(self, mat, vista="general"):
+        """
+        (texto, teclado) de la tarjeta ("general") o de la tabla de calificaciones
+        ("grades") de un alumno, o None si la matrícula no existe. Se renderiza
+        una sola vez por versión de los datos.
+        """
+        mat = normalizar_matricula(mat)
+        clave = (mat, vista)
+        renderizada = self.vistas.get(clave)
+        if renderizada is not None:
+            self.vistas.move_to_end(clave)
+            return renderizada
+        sub = self.registros_por_matricula(mat)
+        if sub.empty:
+            return None
+        if vista == "grades":
+            texto = render_calificaciones(sub)
+        else:
+            texto = render_resumen_alumno(sub.iloc[0], mat)
+        renderizada = (texto, teclado_alumno(mat, vista))
+        self.vistas[clave] = renderizada
+        if len(self.vistas) > STUDENT_VIEW_CACHE_SIZE:
+            self.vistas.popitem(last=False)
+        return renderizada
+
+    def buscar_por_nombre(self, nombres: str, paterno: str, materno: str) -> pd.DataFrame:
+        """
+        Filas cuyos nombre, paterno y materno normalizados contienen cada término.
+        Intersecta las listas de trigramas y sólo verifica los candidatos resultantes.
+        """
+        terminos = dict(zip(CAMPOS_NOMBRE, (nombres, paterno, materno)))
+        candidatos = None
+        # Los términos más largos son los más selectivos: se intersectan primero
+        for campo, termino in sorted(terminos.items(), key=lambda t: -len(t[1])):
+            grams = ngramas(termino)
+            if not grams:
+                continue
+            postings = self.indice_nombres["postings"].get(campo, {})
+            listas = sorted((postings.get(ng, set()) for ng in grams), key=len)
+            encontrados = set(listas[0]).intersection(*listas[1:])
+            candidatos = encontrados if candidatos is None else candidatos & encontrados
+            if not candidatos:
+                return self.df.iloc[0:0]
+        if candidatos is None:
+            candidatos = self.indice_nombres["posiciones"]
+        valores = self.indice_nombres["valores"]
+        coincidencias = sorted(
+            pos for pos in candidatos
+            if all(termino in valores[campo][pos] for campo, termino in terminos.items())
+        )
+        return self.df.iloc[coincidencias]
+
+    def buscar_profesor(self, nombre: str):
+        """Perfiles de los profesores cuyo nombre contiene `nombre`, o None."""
+        nombre = normalizar_profesor(nombre)
+        if not nombre:
+            return None
+        
+        # Coincidencia exacta: acceso directo al perfil
+        perfil = self.perfiles_profesores.get(nombre)
+        if perfil is not None:
+            return [perfil]
+        
+        # Coincidencia parcial sobre los nombres distintos de profesores
+        resultados = [p for clave, p in self.perfiles_profesores.items() if nombre in clave]
+        return resultados or None
+
+def mtime_csv(path):
+    try:
+        return os.path.getmtime(path)
+    except (OSError, TypeError):
+        return None
+
+def firma_fuentes(fuentes) -> tuple:
+    return tuple((clave, ruta, mtime_csv(ruta)) for clave, ruta in fuentes)
+
+def registrar_metricas_datos(d: DatosAcademicos, segundos):
+    metricas.fijar("datos_registros", len(d.df))
+    metricas.fijar("datos_version", d.version)
+    metricas.fijar("datos_carga_segundos", segundos)
+
+def cargar_datos(spec, version=1) -> DatosAcademicos:
+    inicio = time.perf_counter()
+    fuentes = fuentes_csv(spec)
+    firma = firma_fuentes(fuentes)
+    try:
+        df = cargar_fuentes(fuentes)
+    except Exception as e:
+        logger.error("Error al leer/preparar CSV: %s", e)
+        firma, df = None, pd.DataFrame()
+    d = DatosAcademicos(df, version, firma)
+    registrar_metricas_datos(d, time.perf_counter() - inicio)
+    return d
+
+datos = None
+recarga_lock = asyncio.Lock()
+
+async def recargar_datos(forzar=False):
+    """
+    Reconstruye los datos en un hilo aparte mientras se sigue atendiendo con
+    la instantánea actual y después la reemplaza de una sola vez.
+    Devuelve True si se publicó una versión nueva.
+    """
+    global datos
+    async with recarga_lock:
+        fuentes = fuentes_csv(CSV_PATH)
+        firma = firma_fuentes(fuentes)
+        incompleta = not fuentes or any(mtime is None for _, _, mtime in firma)
+        if not forzar and (incompleta or firma == datos.firma):
+            return False
+        inicio = time.perf_counter()
+        try:
+            # Una fuente rota o vacía no debe reemplazar datos que sí funcionan
+            df_nuevo = await asyncio.to_thread(cargar_fuentes, fuentes, True)
+            nuevos = await asyncio.to_thread(DatosAcademicos, df_nuevo, datos.version + 1, firma)
+        except Exception as e:
+            logger.error("Error recargando CSV, se conservan los datos v%d: %s", datos.version, e)
+            return False
+        datos = nuevos
+        registrar_metricas_datos(datos, time.perf_counter() - inicio)
+        cache_respuestas.invalidar()
+        logger.info("Datos recargados: versión %d", datos.version)
+        return True
+
+async def vigilar_csv(intervalo=CSV_POLL_INTERVAL):
+    """Recarga los datos cuando cambia alguna fuente o el conjunto de fuentes."""
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            await recargar_datos()
+        except Exception as e:
+            logger.error("Error vigilando CSV: %s", e)
+
 
 # ─── SISTEMA DE MEMORIA ──────────────────────────────────────────
-class MemorySystem:
-    def __init__(self, file_path=MEMORY_FILE):
+def memoria_vacia():
+    return {
+        "conversaciones": {},
+        "conocimiento": {
+            "alumnos": {},
+            "profesores": {},
+            "materias": {},
+            "carreras": {}
+        }
+    }
+
+def tokenizar(texto) -> set:
+    """Tokens sin acentos ni mayúsculas de al menos 3 caracteres."""
+    texto = quitar_acentos(str(texto).lower())
+    return {t for t in re.findall(r"\w+", texto) if len(t) >= 3}
+
+def unir_keywords(*listas):
+    """Concatena listas de keywords sin repetir, conservando el orden."""
+    vistas = {}
+    for lista in listas:
+        for keyword in lista or []:
+            keyword = str(keyword).strip().lower()
+            if keyword:
+                vistas.setdefault(keyword, None)
+    return list(vistas)
+
+def recortar_historial(historial, message):
+    """Conserva los 10 mensajes más recientes y agrega `message`."""
+    if len(historial) > 10:
+        historial = historial[-10:]
+    historial.append(message)
+    return historial
+
+class MemoryStore(ABC):
+    """
+    Interfaz de almacenamiento de MemorySystem. Las escrituras pueden quedar
+    en búfer hasta `flush()`; `close()` deja todo persistido.
+    """
+    @abstractmethod
+    def load_conversation(self, user_id):
+        ...
+
+    @abstractmethod
+    def append_message(self, user_id, message):
+        ...
+
+    @abstractmethod
+    def get_entity(self, entity_type, entity_id):
+        ...
+
+    @abstractmethod
+    def upsert_entity(self, entity_type, entity_id, data):
+        ...
+
+    @abstractmethod
+    def iter_entities(self):
+        """Genera tuplas (entity_type, entity_id, data)."""
+        ...
+
+    def cambios_externos(self):
+        """
+        None si nadie más modificó el almacenamiento desde la última consulta;
+        si no, (usuarios, entidades): los user_id cuyas conversaciones cambiaron
+        y las tuplas (entity_type, entity_id, data) modificadas desde entonces.
+        """
+        return None
+
+    def tamano_bytes(self):
+        return 0
+
+    def preparar_flush(self):
+        """
+        Se llama con el lock de MemorySystem tomado: separa lo que hay que
+        escribir y devuelve una función que hace la E/S sin el lock (o None si
+        ya no queda nada por hacer).
+        """
+        self.flush()
+        return None
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+class JsonMemoryStore(MemoryStore):
+    """
+    Instantánea JSON en `file_path` más un diario (`<file_path>.journal`, una
+    línea JSON por cambio). `flush()` agrega los cambios pendientes al diario;
+    cada `compact_every` entradas se reescribe la instantánea completa.
+    Con `write_behind=False` cada cambio reescribe la instantánea.
+
+    Las conversaciones y entidades nunca se modifican en su lugar (se
+    reemplazan), así que una copia superficial de `memory` sirve como
+    instantánea para escribir fuera del lock.
+    """
+    def __init__(self, file_path=MEMORY_FILE, write_behind=MEMORY_WRITE_BEHIND,
+                 compact_every=MEMORY_COMPACT_EVERY):
         self.file_path = file_path
+        self.journal_path = file_path + ".journal"
+        self.write_behind = write_behind
+        self.compact_every = compact_every
+        self.seq = 0
+        self.journal_entries = 0
+        self.pending = []
+        # Lote cuya escritura falló: se antepone en el siguiente flush
+        self.reintentar = []
         self.memory = self.load_memory()
-        
+
     def load_memory(self):
+        memory = memoria_vacia()
         try:
             if os.path.exists(self.file_path):
                 with open(self.file_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                    memory = json.load(f)
         except Exception as e:
             logger.error(f"Error cargando memoria: {str(e)}")
-        return {
-            "conversaciones": {},
-            "conocimiento": {
-                "alumnos": {},
-                "profesores": {},
-                "materias": {},
-                "carreras": {}
-            }
+        self.seq = memory.pop("_journal_seq", 0)
+        if self._replay_journal(memory):
+            # Lo siguiente que se agregue quedaría pegado a la línea truncada
+            self.save_memory(dict(memory, _journal_seq=self.seq))
+        return memory
+
+    def _replay_journal(self, memory):
+        """
+        Aplica sobre la instantánea los cambios del diario posteriores a ella.
+        Devuelve True si encontró líneas truncadas.
+        """
+        truncado = False
+        if not os.path.exists(self.journal_path):
+            return truncado
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Línea truncada por una caída a mitad de escritura
+                        truncado = True
+                        continue
+                    self.journal_entries += 1
+                    if entry["seq"] <= self.seq:
+                        continue
+                    self._apply(memory, entry)
+                    self.seq = entry["seq"]
+        except Exception as e:
+            logger.error(f"Error leyendo diario de memoria: {str(e)}")
+        return truncado
+
+    @staticmethod
+    def _apply(memory, entry):
+        if entry["op"] == "conversation":
+            conversaciones = memory["conversaciones"]
+            user_id = entry["user_id"]
+            conversaciones[user_id] = recortar_historial(
+                list(conversaciones.get(user_id, [])), entry["message"]
+            )
+        elif entry["op"] == "knowledge":
+            conocimiento = memory["conocimiento"]
+            entity_type, entity_id, data = entry["entity_type"], entry["entity_id"], entry["data"]
+            if entity_type not in conocimiento:
+                conocimiento[entity_type] = {}
+            anterior = conocimiento[entity_type].get(entity_id, {})
+            conocimiento[entity_type][entity_id] = {**anterior, **data}
+
+    def _record(self, entry):
+        self.seq += 1
+        entry["seq"] = self.seq
+        self._apply(self.memory, entry)
+        if not self.write_behind:
+            self.save_memory()
+            return
+        self.pending.append(json.dumps(entry, ensure_ascii=False, default=str))
+
+    def load_conversation(self, user_id):
+        return self.memory["conversaciones"].get(str(user_id), [])
+
+    def append_message(self, user_id, message):
+        self._record({"op": "conversation", "user_id": str(user_id), "message": message})
+
+    def get_entity(self, entity_type, entity_id):
+        return self.memory["conocimiento"].get(entity_type, {}).get(entity_id, {})
+
+    def upsert_entity(self, entity_type, entity_id, data):
+        self._record({
+            "op": "knowledge",
+            "entity_type": entity_type,
+            "entity_id": entity_id,
+            "data": data
+        })
+
+    def iter_entities(self):
+        for entity_type, entidades in self.memory["conocimiento"].items():
+            for entity_id, data in entidades.items():
+                yield entity_type, entity_id, data
+
+    def preparar_flush(self):
+        """Toma los cambios pendientes y, si toca compactar, una instantánea de la memoria."""
+        lote, self.reintentar, self.pending = self.reintentar + self.pending, [], []
+        if not lote:
+            return None
+        instantanea = None
+        if self.journal_entries + len(lote) >= self.compact_every:
+            instantanea = self._instantanea()
+        return lambda: self._escribir(lote, instantanea)
+
+    def _escribir(self, lote, instantanea):
+        """Agrega `lote` al diario y, con `instantanea`, compacta."""
+        try:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write("\n".join(lote) + "\n")
+            self.journal_entries += len(lote)
+        except Exception as e:
+            logger.error(f"Error escribiendo diario de memoria: {str(e)}")
+            self.reintentar = lote
+            return
+        if instantanea is not None:
+            self.save_memory(instantanea)
+
+    def flush(self):
+        """Agrega al diario los cambios pendientes y compacta si corresponde."""
+        escribir = self.preparar_flush()
+        if escribir is not None:
+            escribir()
+
+    def close(self):
+        self.flush()
+        if self.journal_entries:
+            self.save_memory()
+
+    def tamano_bytes(self):
+        return sum(os.path.getsize(p) for p in (self.file_path, self.journal_path)
+                   if os.path.exists(p))
+
+    def _instantanea(self):
+        memory = dict(self.memory, _journal_seq=self.seq)
+        memory["conversaciones"] = dict(memory["conversaciones"])
+        memory["conocimiento"] = {
+            entity_type: dict(entidades) for entity_type, entidades in memory["conocimiento"].items()
         }
-    
-    def save_memory(self):
+        return memory
+
+    def save_memory(self, snapshot=None):
+        """Reescribe la instantánea completa (por defecto la memoria actual) y vacía el diario."""
         try:
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                json.dump(self.memory, f, ensure_ascii=False, indent=2)
+            if snapshot is None:
+                snapshot = dict(self.memory, _journal_seq=self.seq)
+            tmp_path = self.file_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, self.file_path)
+            # La instantánea ya incluye todo lo anterior a `seq`
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self.journal_entries = 0
         except Exception as e:
             logger.error(f"Error guardando memoria: {str(e)}")
-    
+
+class SqliteMemoryStore(MemoryStore):
+    """
+    Memoria en una base SQLite embebida: una fila por mensaje (indexada por
+    user_id) y una por entidad (clave entity_type, entity_id). Las escrituras
+    se confirman en `flush()`. La primera vez importa `legacy_path` (memory.json).
+    """
+    def __init__(self, db_path=MEMORY_DB, legacy_path=MEMORY_FILE):
+        self.db_path = db_path
+        # MemorySystem serializa el acceso; el flush puede correr en otro hilo
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS conversaciones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_conversaciones_user
+                ON conversaciones (user_id, id);
+            CREATE TABLE IF NOT EXISTS conocimiento (
+                entity_type TEXT NOT NULL,
+                entity_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                cambio INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (entity_type, entity_id)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                clave TEXT PRIMARY KEY,
+                valor TEXT
+            );
+        """)
+        columnas = {fila[1] for fila in self.conn.execute("PRAGMA table_info(conocimiento)")}
+        if "cambio" not in columnas:
+            # Bases creadas antes de la sincronización incremental
+            self.conn.execute("ALTER TABLE conocimiento ADD COLUMN cambio INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_conocimiento_cambio ON conocimiento (cambio)")
+        self.conn.commit()
+        self._migrate(legacy_path)
+        self._data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        # Últimos mensaje y cambio de entidad vistos (para cambios_externos)
+        self._ultimo_mensaje = self.conn.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM conversaciones").fetchone()[0]
+        self._ultimo_cambio = self.conn.execute(
+            "SELECT COALESCE(MAX(cambio), 0) FROM conocimiento").fetchone()[0]
+
+    def _migrate(self, legacy_path):
+        """Importa una sola vez el memory.json (instantánea + diario) existente."""
+        if self.conn.execute("SELECT 1 FROM meta WHERE clave = 'migrado'").fetchone():
+            return
+        if legacy_path and (os.path.exists(legacy_path) or os.path.exists(legacy_path + ".journal")):
+            memory = JsonMemoryStore(legacy_path, write_behind=False).memory
+            for user_id, historial in memory.get("conversaciones", {}).items():
+                self.conn.executemany(
+                    "INSERT INTO conversaciones (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                    [(str(user_id), m.get("role", ""), m.get("content", ""), m.get("timestamp"))
+                     for m in historial]
+                )
+            for entity_type, entidades in memory.get("conocimiento", {}).items():
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO conocimiento (entity_type, entity_id, data) VALUES (?, ?, ?)",
+                    [(entity_type, str(entity_id), json.dumps(data, ensure_ascii=False, default=str))
+                     for entity_id, data in entidades.items()]
+                )
+            logger.info("Memoria migrada de %s a %s", legacy_path, self.db_path)
+        self.conn.execute("INSERT INTO meta (clave, valor) VALUES ('migrado', ?)",
+                          (datetime.now().isoformat(),))
+        self.conn.commit()
+
+    def load_conversation(self, user_id):
+        rows = self.conn.execute(
+            "SELECT role, content, timestamp FROM ("
+            "  SELECT id, role, content, timestamp FROM conversaciones"
+            "  WHERE user_id = ? ORDER BY id DESC LIMIT 11"
+            ") ORDER BY id",
+            (str(user_id),)
+        ).fetchall()
+        return [{"role": r, "content": c, "timestamp": t} for r, c, t in rows]
+
+    def append_message(self, user_id, message):
+        user_id = str(user_id)
+        self.conn.execute(
+            "INSERT INTO conversaciones (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+            (user_id, message["role"], message["content"], message.get("timestamp"))
+        )
+        # Mismo recorte que recortar_historial: sólo los 11 más recientes
+        self.conn.execute(
+            "DELETE FROM conversaciones WHERE user_id = ? AND id NOT IN ("
+            "  SELECT id FROM conversaciones WHERE user_id = ? ORDER BY id DESC LIMIT 11"
+            ")",
+            (user_id, user_id)
+        )
+
+    def get_entity(self, entity_type, entity_id):
+        row = self.conn.execute(
+            "SELECT data FROM conocimiento WHERE entity_type = ? AND entity_id = ?",
+            (entity_type, str(entity_id))
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def upsert_entity(self, entity_type, entity_id, data):
+        actual = self.get_entity(entity_type, entity_id)
+        actual.update(data)
+        # `cambio` crece con cada escritura (la base admite un solo escritor a la vez)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO conocimiento (entity_type, entity_id, data, cambio) VALUES "
+            "(?, ?, ?, (SELECT COALESCE(MAX(cambio), 0) + 1 FROM conocimiento))",
+            (entity_type, str(entity_id), json.dumps(actual, ensure_ascii=False, default=str))
+        )
+
+    def iter_entities(self):
+        for entity_type, entity_id, data in self.conn.execute(
+            "SELECT entity_type, entity_id, data FROM conocimiento"
+        ).fetchall():
+            yield entity_type, entity_id, json.loads(data)
+
+    def tamano_bytes(self):
+        return sum(os.path.getsize(p) for p in (self.db_path, self.db_path + "-wal")
+                   if os.path.exists(p))
+
+    def cambios_externos(self):
+        # data_version sólo cambia con commits de otras conexiones
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return None
+        self._data_version = version
+        filas = self.conn.execute(
+            "SELECT user_id, id FROM conversaciones WHERE id > ?", (self._ultimo_mensaje,)
+        ).fetchall()
+        usuarios = {user_id for user_id, _ in filas}
+        self._ultimo_mensaje = max((i for _, i in filas), default=self._ultimo_mensaje)
+        filas = self.conn.execute(
+            "SELECT entity_type, entity_id, data, cambio FROM conocimiento WHERE cambio > ?",
+            (self._ultimo_cambio,)
+        ).fetchall()
+        entidades = [(t, i, json.loads(data)) for t, i, data, _ in filas]
+        self._ultimo_cambio = max((c for *_, c in filas), default=self._ultimo_cambio)
+        return usuarios, entidades
+
+    def flush(self):
+        try:
+            self.conn.commit()
+        except Exception as e:
+            logger.error(f"Error guardando memoria: {str(e)}")
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+class MemorySystem:
+    """
+    Memoria de conversaciones y conocimiento sobre un MemoryStore intercambiable
+    (`MEMORY_BACKEND`: json o sqlite). El historial de cada usuario se carga
+    sólo cuando se necesita y se guarda en una caché LRU de `cache_users`
+    usuarios. Los cambios se persisten con `store.flush()` a los
+    `flush_interval` segundos del primero (o al cerrar).
+
+    Las keywords de las entidades se mantienen en un índice invertido
+    token -> entidades, construido al primer uso y actualizado en cada
+    `update_knowledge`.
+
+    Con `compartida=True` (varios procesos sobre la misma base SQLite), cuando
+    otro proceso confirma cambios se descartan sólo los historiales de los
+    usuarios afectados y se reindexan sólo las entidades modificadas.
+
+    Todas las operaciones toman `_lock`, así que los handlers concurrentes
+    nunca ven el almacenamiento a medio modificar. El flush corre en un hilo
+    del executor: con el lock sólo separa los cambios pendientes
+    (`store.preparar_flush()`) y la escritura a disco se hace sin él, bajo
+    `_escritura`, que mantiene los lotes en orden.
+    """
+    def __init__(self, store=None, flush_interval=MEMORY_FLUSH_INTERVAL,
+                 cache_users=MEMORY_CACHE_USERS, compartida=False):
+        self.store = store if store is not None else crear_memory_store()
+        self.flush_interval = flush_interval
+        self.cache_users = cache_users
+        self.compartida = compartida
+        self._lock = threading.RLock()
+        self._escritura = threading.Lock()
+        self.conversaciones = OrderedDict()
+        self.indice_keywords = None
+        self.tokens_por_entidad = {}
+        self._flush_handle = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def _schedule_flush(self):
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Sin event loop (scripts, consola): escribir de inmediato
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(self.flush_interval, self._flush_en_segundo_plano)
+
+    def _flush_en_segundo_plano(self):
+        self._flush_handle = None
+        asyncio.get_running_loop().run_in_executor(None, self._flush_store)
+
+    def _flush_store(self):
+        with self._escritura:
+            inicio = time.perf_counter()
+            with self._lock:
+                if self._closed:
+                    return
+                escribir = self.store.preparar_flush()
+            if escribir is not None:
+                escribir()
+            metricas.observar("memoria_guardado_segundos", time.perf_counter() - inicio)
+            metricas.fijar("memoria_archivo_bytes", self.store.tamano_bytes())
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._flush_store()
+
+    def close(self):
+        with self._escritura, self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            self.store.close()
+
+    def _sincronizar(self):
+        if not self.compartida:
+            return
+        cambios = self.store.cambios_externos()
+        if cambios is None:
+            return
+        usuarios, entidades = cambios
+        for user_id in usuarios:
+            self.conversaciones.pop(user_id, None)
+        if self.indice_keywords is not None:
+            for entity_type, entity_id, data in entidades:
+                self._indexar_entidad(entity_type, entity_id, data.get("keywords", []))
+
     def update_conversation(self, user_id, role, content):
-        if str(user_id) not in self.memory["conversaciones"]:
-            self.memory["conversaciones"][str(user_id)] = []
-        
-        if len(self.memory["conversaciones"][str(user_id)]) > 10:
-            self.memory["conversaciones"][str(user_id)] = self.memory["conversaciones"][str(user_id)][-10:]
-        
-        self.memory["conversaciones"][str(user_id)].append({
+        user_id = str(user_id)
+        message = {
             "role": role,
             "content": content,
             "timestamp": datetime.now().isoformat()
-        })
-        self.save_memory()
-    
+        }
+        with self._lock:
+            # Copia nueva: quien ya tenía el historial anterior no lo ve cambiar
+            historial = list(self.get_conversation_history(user_id))
+            self.conversaciones[user_id] = recortar_historial(historial, message)
+            self.store.append_message(user_id, message)
+        self._schedule_flush()
+
     def get_conversation_history(self, user_id):
-        return self.memory["conversaciones"].get(str(user_id), [])
-    
+        user_id = str(user_id)
+        with self._lock:
+            self._sincronizar()
+            if user_id in self.conversaciones:
+                self.conversaciones.move_to_end(user_id)
+                return self.conversaciones[user_id]
+            historial = self.store.load_conversation(user_id)
+            self.conversaciones[user_id] = historial
+            if len(self.conversaciones) > self.cache_users:
+                self.conversaciones.popitem(last=False)
+            return historial
+
+    def _construir_indice_keywords(self):
+        self.indice_keywords = {}
+        self.tokens_por_entidad = {}
+        for entity_type, entity_id, data in self.store.iter_entities():
+            self._indexar_entidad(entity_type, entity_id, data.get("keywords", []))
+
+    def _indexar_entidad(self, entity_type, entity_id, keywords):
+        clave = (entity_type, str(entity_id))
+        for token in self.tokens_por_entidad.pop(clave, ()):
+            postings = self.indice_keywords.get(token)
+            if postings is not None:
+                postings.discard(clave)
+                if not postings:
+                    del self.indice_keywords[token]
+        tokens = set()
+        for keyword in keywords:
+            tokens |= tokenizar(keyword)
+        for token in tokens:
+            self.indice_keywords.setdefault(token, set()).add(clave)
+        if tokens:
+            self.tokens_por_entidad[clave] = tokens
+
     def update_knowledge(self, entity_type, entity_id, data):
-        if entity_type not in self.memory["conocimiento"]:
-            self.memory["conocimiento"][entity_type] = {}
-        
-        if entity_id not in self.memory["conocimiento"][entity_type]:
-            self.memory["conocimiento"][entity_type][entity_id] = data
-        else:
-            self.memory["conocimiento"][entity_type][entity_id].update(data)
-        
-        self.save_memory()
-    
+        data = dict(data)
+        with self._lock:
+            self._sincronizar()
+            if self.indice_keywords is None:
+                self._construir_indice_keywords()
+            if "keywords" in data:
+                # Acumula las keywords de la entidad en lugar de repetirlas o perderlas
+                anteriores = self.store.get_entity(entity_type, entity_id).get("keywords", [])
+                data["keywords"] = unir_keywords(anteriores, data["keywords"])
+                self._indexar_entidad(entity_type, entity_id, data["keywords"])
+            self.store.upsert_entity(entity_type, entity_id, data)
+        self._schedule_flush()
+
     def get_knowledge(self, entity_type, entity_id):
-        return self.memory["conocimiento"][entity_type].get(entity_id, {})
-    
-    def get_related_knowledge(self, query):
-        related = {}
-        for entity_type in self.memory["conocimiento"]:
-            for entity_id, data in self.memory["conocimiento"][entity_type].items():
-                if any(keyword in query.lower() for keyword in data.get("keywords", [])):
-                    related[f"{entity_type}_{entity_id}"] = data
-        return related
+        with self._lock:
+            return self.store.get_entity(entity_type, entity_id)
+
+    def get_related_knowledge(self, query, limit=MEMORY_RELATED_MAX):
+        """
+        Entidades cuyas keywords comparten tokens con la consulta, ordenadas
+        por cantidad de tokens en común; como máximo `limit`.
+        """
+        with self._lock:
+            self._sincronizar()
+            if self.indice_keywords is None:
+                self._construir_indice_keywords()
+            puntajes = {}
+            for token in tokenizar(query):
+                for clave in self.indice_keywords.get(token, ()):
+                    puntajes[clave] = puntajes.get(clave, 0) + 1
+            mejores = sorted(puntajes.items(), key=lambda item: (-item[1], item[0]))[:limit]
+            related = {}
+            for (entity_type, entity_id), _ in mejores:
+                related[f"{entity_type}_{entity_id}"] = self.store.get_entity(entity_type, entity_id)
+            return related
 
-# Inicializar sistema de memoria
-memory_system = MemorySystem()
+def crear_memory_store():
+    if MEMORY_BACKEND == "sqlite":
+        return SqliteMemoryStore(MEMORY_DB, legacy_path=MEMORY_FILE)
+    return JsonMemoryStore(MEMORY_FILE)
+
+# Se crea en inicializar()
+memory_system = None
 
 # ─── CLIENTE OPENAI ─────────────────────────────────────────────
-client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+client = None
 
-# ─── AYUDANTE: NORMALIZAR TEXTO ─────────────────────────────────
-def quitar_acentos(texto: str) -> str:
-    if not isinstance(texto, str):
-        return texto
-    texto = re.sub(r"[^\w\s]", "", texto)
-    n = unicodedata.normalize("NFD", texto)
-    return "".join(c for c in n if unicodedata.category(c) != "Mn")
+def crear_cliente_openai():
+    if not OPENAI_API_KEY:
+        return None
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, timeout=OPENAI_TIMEOUT)
+
+# Límite global de llamadas simultáneas a OpenAI
+llm_semaforo = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+def registrar_llamada_openai(tipo, inicio, usage=None, error=False):
+    metricas.incrementar("openai_llamadas_total", tipo=tipo, resultado="error" if error else "ok")
+    metricas.observar("openai_segundos", time.perf_counter() - inicio, tipo=tipo)
+    if usage is not None:
+        metricas.incrementar("openai_tokens_total", usage.prompt_tokens or 0, tipo="prompt")
+        metricas.incrementar("openai_tokens_total", usage.completion_tokens or 0, tipo="respuesta")
+
+async def completar_chat(**kwargs):
+    """Llamada a chat.completions sin bloquear el event loop del bot."""
+    kwargs.setdefault("model", OPENAI_MODEL)
+    kwargs.setdefault("timeout", OPENAI_TIMEOUT)
+    async with llm_semaforo:
+        inicio = time.perf_counter()
+        try:
+            response = await client.chat.completions.create(**kwargs)
+        except Exception:
+            registrar_llamada_openai("chat", inicio, error=True)
+            raise
+    usage = getattr(response, "usage", None)
+    registrar_llamada_openai("chat", inicio, usage)
+    if usage is not None:
+        logger.info(
+            "OpenAI: %s tokens de prompt, %s de respuesta en %.2f s",
+            usage.prompt_tokens, usage.completion_tokens, time.perf_counter() - inicio
+        )
+    return response
+
+async def transmitir_chat(al_recibir, **kwargs):
+    """
+    Como completar_chat pero en modo stream: llama `al_recibir(texto_acumulado)`
+    con cada fragmento y devuelve el texto completo.
+    """
+    kwargs.setdefault("model", OPENAI_MODEL)
+    kwargs.setdefault("timeout", OPENAI_TIMEOUT)
+    partes = []
+    primer_token = None
+    usage = None
+    async with llm_semaforo:
+        inicio = time.perf_counter()
+        try:
+            stream = await client.chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, **kwargs
+            )
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if primer_token is None:
+                    primer_token = time.perf_counter() - inicio
+                partes.append(chunk.choices[0].delta.content)
+                await al_recibir("".join(partes))
+        except Exception:
+            registrar_llamada_openai("stream", inicio, error=True)
+            raise
+    registrar_llamada_openai("stream", inicio, usage)
+    logger.info(
+        "OpenAI stream: primer token en %.2f s, total %.2f s, %s tokens de prompt, %s de respuesta",
+        primer_token or 0.0, time.perf_counter() - inicio,
+        usage.prompt_tokens if usage else "?", usage.completion_tokens if usage else "?"
+    )
+    return "".join(partes)
+
+# ─── EXTRACCIÓN DE CONOCIMIENTO EN SEGUNDO PLANO ────────────────
+def guardar_entidades(entities):
+    """Guarda en memoria las entidades devueltas por el extractor."""
+    for entity_type, items in entities.items():
+        if not isinstance(items, dict):
+            continue
+        for entity_id, data in items.items():
+            if not isinstance(data, dict):
+                data = {"valor": data}
+            data['keywords'] = unir_keywords(
+                data.get('keywords', []),
+                re.findall(r'\b\w+\b', str(entity_id).lower()),
+                re.findall(r'\b\w+\b', str(data.get('nombre', '')).lower())
+            )
+            memory_system.update_knowledge(entity_type, entity_id, data)
+
+class ExtractorConocimiento:
+    """
+    Cola acotada de interacciones (consulta, respuesta) que un worker en
+    segundo plano agrupa en lotes de hasta `batch_size` (o lo acumulado en
+    `batch_wait` segundos) y envía al modelo en una sola extracción.
+    Si la cola está llena se descarta la interacción más antigua.
+    """
+    def __init__(self, max_queue=EXTRACTOR_QUEUE_MAX, batch_size=EXTRACTOR_BATCH_SIZE,
+                 batch_wait=EXTRACTOR_BATCH_WAIT):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = None
+        self.task = None
+        self.descartadas = 0
+
+    def encolar(self, consulta, respuesta):
+        if self.task is None or self.task.done():
+            if self.queue is None:
+                self.queue = asyncio.Queue(maxsize=self.max_queue)
+            self.task = asyncio.get_running_loop().create_task(self._worker())
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.descartadas += 1
+            logger.warning("Cola del extractor llena; %d interacciones descartadas", self.descartadas)
+        self.queue.put_nowait((consulta, respuesta))
+
+    async def _siguiente_lote(self):
+        lote = [await self.queue.get()]
+        limite = asyncio.get_running_loop().time() + self.batch_wait
+        while len(lote) < self.batch_size:
+            restante = limite - asyncio.get_running_loop().time()
+            if restante <= 0:
+                break
+            try:
+                lote.append(await asyncio.wait_for(self.queue.get(), restante))
+            except asyncio.TimeoutError:
+                break
+        return lote
+
+    async def _worker(self):
+        while True:
+            lote = await self._siguiente_lote()
+            try:
+                await self._extraer(lote)
+            except Exception as e:
+                logger.error(f"Error actualizando conocimiento: {str(e)}")
+            finally:
+                for _ in lote:
+                    self.queue.task_done()
+
+    async def _extraer(self, lote):
+        interacciones = "\n\n".join(
+            f"[{i}] Consulta: {consulta}\nRespuesta: {respuesta}"
+            for i, (consulta, respuesta) in enumerate(lote, 1)
+        )
+        self_update_prompt = (
+            "Analiza las interacciones y extrae entidades importantes: "
+            "alumnos (por matrícula), profesores (por nombre), materias, carreras. "
+            "Devuelve un único JSON con estructura: "
+            "{'alumnos': {matricula: {data}}, 'profesores': {nombre: {data}}, 'materias': {nombre: {data}}, 'carreras': {nombre: {data}}}"
+            f"\n\n{interacciones}"
+        )
+        update_response = await completar_chat(
+            messages=[
+                {"role": "system", "content": "Eres un extractor de información especializado"},
+                {"role": "user", "content": self_update_prompt}
+            ],
+            temperature=0.1,
+            max_tokens=500,
+            response_format={"type": "json_object"}
+        )
+        guardar_entidades(json.loads(update_response.choices[0].message.content))
+
+    async def detener(self, timeout=10):
+        """Procesa lo pendiente (hasta `timeout` segundos) y detiene el worker."""
+        if self.task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Extractor detenido con %d interacciones pendientes", self.queue.qsize())
+        self.task.cancel()
+        self.task = None
+
+extractor = ExtractorConocimiento()
 
 # ─── BUSCAR PROFESOR ────────────────────────────────────────────
 def buscar_profesor(nombre: str):
-    nombre = quitar_acentos(nombre).lower().strip()
-    if not nombre:
+    """Perfiles de los profesores cuyo nombre contiene `nombre`, o None."""
+    return datos.buscar_profesor(nombre)
+
+# ─── MOTOR DE CONSULTAS LOCAL ────────────────────────────────────
+# Orden de prioridad: la primera intención que aparece en la consulta gana
+INTENCIONES = (
+    ("reprobados", re.compile(r"\breprobad[oa]s?\b|\breprueban?\b")),
+    ("aprobados", re.compile(r"\baprobad[oa]s?\b|\baprueban?\b")),
+    ("promedio", re.compile(r"\bpromedios?\b")),
+    ("materias", re.compile(r"\bmaterias\b|\basignaturas\b")),
+    ("alumnos", re.compile(r"\balumn[oa]s\b|\bestudiantes\b")),
+)
+# Preguntas comparativas o abiertas que se dejan al modelo
+PATRON_NO_LOCAL = re.compile(r"\b(mejor|mejores|peor|peores|mayor|menor|ranking|compara\w*|por que|como)\b")
+PATRON_CUATRIMESTRE = re.compile(r"\bcuatrimestre\s+(\d{1,2})\b|\b(\d{1,2})(?:er|do|ro|to|vo|no|mo|o)?\s+cuatrimestre\b")
+PATRON_PROFESOR = re.compile(r"\b(?:profesora?|docente|maestr[oa])\s+([a-z ]+)")
+# "alumnos de alicia murillo": posible profesor sin la palabra "profesor"
+PATRON_DE = re.compile(r"\bdel?\s+([a-z ]+)")
+PALABRAS_VACIAS = {"la", "las", "el", "los", "un", "una", "y", "e", "en", "de", "del", "mi", "mis"}
+LIMITE_LISTA = 20
+
+def encontrar_entidad(vocabulario: dict, consulta: str):
+    """Valor original de la entidad más larga mencionada (como palabras completas)."""
+    mejor = None
+    for norm, valor in vocabulario.items():
+        if norm in consulta and (mejor is None or len(norm) > len(mejor[0])):
+            if re.search(rf"\b{re.escape(norm)}\b", consulta):
+                mejor = (norm, valor)
+    return mejor[1] if mejor else None
+
+def profesores_por_palabras(d: DatosAcademicos, palabras, completas=False):
+    """
+    Perfiles del prefijo más largo de `palabras` que coincide con algún
+    profesor ("alicia murillo en cuatrimestre 5" -> "alicia murillo"), o None.
+    Con `completas` cada palabra debe coincidir con palabras enteras del nombre.
+    """
+    for n in range(len(palabras), 0, -1):
+        nombre = " ".join(palabras[:n])
+        perfiles = d.buscar_profesor(nombre)
+        if perfiles and completas:
+            patron = re.compile(rf"\b{re.escape(nombre)}\b")
+            perfiles = [p for p in perfiles if patron.search(normalizar_profesor(p["Profesor"]))]
+        if perfiles:
+            return perfiles
+    return None
+
+def interpretar_consulta(d: DatosAcademicos, consulta: str):
+    """
+    Reconoce preguntas de agregación/filtrado sobre Carrera, Materia, Profesor y
+    Cuatrimestre. Devuelve (intención, filtros) o None si no es una de ellas.
+    """
+    q = normalizar_consulta(consulta)
+    if PATRON_NO_LOCAL.search(q):
         return None
-    
-    # Buscar coincidencias exactas o parciales en PROFESORES
-    mask = df['Profesor_Norm'].str.contains(nombre, na=False)
-    resultados = df[mask]
-    
-    if resultados.empty:
+    intencion = next((nombre for nombre, patron in INTENCIONES if patron.search(q)), None)
+    if intencion is None:
         return None
+
+    filtros = {}
+    for col in COLUMNAS_ENTIDAD:
+        valor = encontrar_entidad(d.vocabulario[col], q)
+        if valor is not None:
+            filtros[col] = valor
+    match = PATRON_PROFESOR.search(q)
+    if "Profesor" not in filtros and match:
+        # "profesor alicia en cuatrimestre 5": se prueba con menos palabras hasta acertar
+        perfiles = profesores_por_palabras(d, match.group(1).split())
+        if perfiles is None:
+            # Mencionó a un profesor que no existe: no inventar una respuesta
+            return None
+        if len(perfiles) == 1:
+            filtros["Profesor"] = perfiles[0]["Profesor"]
+    elif "Profesor" not in filtros:
+        # "alumnos de alicia murillo": nombre parcial sin "profesor"; sólo si es inequívoco
+        for match in PATRON_DE.finditer(q):
+            palabras = match.group(1).split()
+            if not palabras or palabras[0] in PALABRAS_VACIAS or len(palabras[0]) < 3:
+                continue
+            perfiles = profesores_por_palabras(d, palabras, completas=True)
+            if perfiles is not None and len(perfiles) == 1:
+                filtros["Profesor"] = perfiles[0]["Profesor"]
+                break
+    match = PATRON_CUATRIMESTRE.search(q)
+    if match:
+        filtros["Cuatrimestre"] = int(match.group(1) or match.group(2))
+
+    # Sin ningún filtro la pregunta suele ser sobre un alumno u otra cosa
+    if not filtros:
+        return None
+    return intencion, filtros
+
+def describir_filtros(filtros: dict) -> str:
+    partes = [str(filtros[col]) for col in COLUMNAS_ENTIDAD if col in filtros]
+    if "Cuatrimestre" in filtros:
+        partes.append(f"cuatrimestre {filtros['Cuatrimestre']}")
+    return " · ".join(partes)
+
+def nota_sin_calificacion(n) -> str:
+    return f"\n⚪ Sin calificación registrada: {n} registros" if n else ""
+
+def listar(lineas, total):
+    texto = "\n".join(lineas[:LIMITE_LISTA])
+    if total > LIMITE_LISTA:
+        texto += f"\n\nY {total - LIMITE_LISTA} más..."
+    return texto
+
+def ejecutar_consulta(d: DatosAcademicos, intencion: str, filtros: dict) -> str:
+    """Resuelve la consulta con operaciones vectorizadas sobre el DataFrame."""
+    df = d.df
+    mascara = np.ones(len(df), dtype=bool)
+    for col, valor in filtros.items():
+        mascara &= (df[col] == valor).to_numpy()
+    sub = df[mascara]
+    desc = describir_filtros(filtros)
+    if sub.empty:
+        return f"🔍 No encontré registros para: {desc}"
+
+    # Las intenciones de calificaciones sólo cuentan registros con calificación
+    calificados = sub[sub["Calificacion"].notna()]
+    sin_calificacion = len(sub) - len(calificados)
+
+    if intencion == "promedio":
+        if calificados.empty:
+            return f"📊 No hay calificaciones registradas para: {desc}" + nota_sin_calificacion(sin_calificacion)
+        cal = calificados["Calificacion"]
+        return (
+            f"📊 Promedio de calificaciones ({desc}): {cal.mean():.2f}\n"
+            f"👥 Alumnos: {calificados['Matricula'].nunique()} | Registros: {len(calificados)}\n"
+            f"🔻 Mínima: {cal.min():.1f} | 🔺 Máxima: {cal.max():.1f}"
+        ) + nota_sin_calificacion(sin_calificacion)
+
+    if intencion in ("reprobados", "aprobados"):
+        reprobado = calificados["Calificacion"] < CALIFICACION_APROBATORIA
+        elegidos = calificados[reprobado if intencion == "reprobados" else ~reprobado]
+        titulo = "❌ Reprobados" if intencion == "reprobados" else "✅ Aprobados"
+        encabezado = (
+            f"{titulo} ({desc}; mínima aprobatoria {CALIFICACION_APROBATORIA:g}): "
+            f"{len(elegidos)} de {len(calificados)} registros calificados"
+        ) + nota_sin_calificacion(sin_calificacion)
+        if elegidos.empty:
+            return encabezado
+        lineas = [
+            f"- {nombre} — {materia}: {cal:g}"
+            for nombre, materia, cal in zip(
+                elegidos["Nombre_Completo"], elegidos["Materia"], elegidos["Calificacion"]
+            )
+        ]
+        return encabezado + "\n\n" + listar(lineas, len(lineas))
+
+    if intencion == "materias":
+        por_materia = sub.groupby("Materia", observed=True)["Calificacion"].agg(["mean", "count", "size"])
+        lineas = []
+        for materia, fila in por_materia.iterrows():
+            promedio = f"promedio {fila['mean']:.2f}" if fila["count"] else "sin calificaciones"
+            faltantes = int(fila["size"] - fila["count"])
+            detalle = f", {faltantes} sin calificación" if faltantes and fila["count"] else ""
+            lineas.append(f"- {materia} ({promedio}, {int(fila['size'])} registros{detalle})")
+        return f"📚 Materias ({desc}): {len(lineas)}\n\n" + listar(lineas, len(lineas))
+
+    # alumnos
+    alumnos = sub.drop_duplicates("Matricula")
+    if "Materia" in filtros:
+        lineas = [
+            f"- {nombre} ({mat}) — {cal:g}" if pd.notna(cal) else f"- {nombre} ({mat}) — sin calificación"
+            for nombre, mat, cal in zip(alumnos["Nombre_Completo"], alumnos["Matricula"], alumnos["Calificacion"])
+        ]
+    else:
+        lineas = [
+            f"- {nombre} ({mat})"
+            for nombre, mat in zip(alumnos["Nombre_Completo"], alumnos["Matricula"])
+        ]
+    return f"👥 Alumnos ({desc}): {len(alumnos)}\n\n" + listar(lineas, len(lineas))
+
+def responder_consulta_local(d: DatosAcademicos, consulta: str):
+    """Respuesta exacta calculada localmente, o None si hay que usar el modelo."""
+    interpretacion = interpretar_consulta(d, consulta)
+    if interpretacion is None:
+        return None
+    intencion, filtros = interpretacion
+    logger.info("Consulta local: %s %s", intencion, filtros)
+    return ejecutar_consulta(d, intencion, filtros)
+
+# ─── HERRAMIENTAS PARA EL MODELO ─────────────────────────────────
+def resolver_entidad(d: DatosAcademicos, col: str, texto):
+    """Valor original de `col` que coincide (exacta o parcialmente) con `texto`."""
+    if not texto:
+        return None
+    norm = normalizar_consulta(str(texto))
+    vocabulario = d.vocabulario[col]
+    if norm in vocabulario:
+        return vocabulario[norm]
+    parciales = [clave for clave in vocabulario if norm in clave]
+    return vocabulario[min(parciales, key=len)] if parciales else None
+
+def numero_json(valor, decimales=None):
+    """float apto para JSON: las calificaciones faltantes (NaN) pasan a null."""
+    if pd.isna(valor):
+        return None
+    return round(float(valor), decimales) if decimales is not None else float(valor)
+
+def herramienta_alumno(d: DatosAcademicos, matricula):
+    sub = d.registros_por_matricula(matricula)
+    if sub.empty:
+        return {"error": f"Matrícula {matricula} no encontrada"}
+    r = sub.iloc[0]
+    return {
+        "matricula": normalizar_matricula(r["Matricula"]),
+        "nombre": r["Nombre_Completo"],
+        "carrera": r["Carrera"],
+        "cuatrimestre": int(r["Cuatrimestre"]),
+        "promedio_general": numero_json(r["Promedio_General"], 2),
+        "calificaciones": [
+            {"materia": m, "calificacion": numero_json(c), "profesor": p}
+            for m, c, p in zip(sub["Materia"], sub["Calificacion"], sub["Profesor"])
+        ],
+    }
+
+def herramienta_profesor(d: DatosAcademicos, nombre):
+    perfiles = d.buscar_profesor(nombre or "")
+    if not perfiles:
+        return {"error": f"No se encontró al profesor: {nombre}"}
+    return {"profesores": [
+        dict(p, Promedio_Calificaciones=numero_json(p["Promedio_Calificaciones"], 2))
+        for p in perfiles[:5]
+    ]}
+
+def filtrar_registros(d: DatosAcademicos, materia=None, profesor=None, carrera=None, cuatrimestre=None,
+                      fuente=None):
+    filtros = {}
+    for col, texto in (("Materia", materia), ("Profesor", profesor), ("Carrera", carrera),
+                       ("Fuente", fuente)):
+        if texto:
+            valor = resolver_entidad(d, col, texto)
+            if valor is None:
+                return None, {"error": f"{col} no encontrada: {texto}"}
+            filtros[col] = valor
+    if cuatrimestre is not None:
+        filtros["Cuatrimestre"] = int(cuatrimestre)
+    mascara = np.ones(len(d.df), dtype=bool)
+    for col, valor in filtros.items():
+        mascara &= (d.df[col] == valor).to_numpy()
+    return d.df[mascara], filtros
+
+def herramienta_promedio(d: DatosAcademicos, materia=None, profesor=None, carrera=None, cuatrimestre=None,
+                         fuente=None):
+    sub, filtros = filtrar_registros(d, materia, profesor, carrera, cuatrimestre, fuente)
+    if sub is None:
+        return filtros
+    if sub.empty:
+        return {"filtros": filtros, "registros": 0}
+    calificados = sub[sub["Calificacion"].notna()]
+    cal = calificados["Calificacion"]
+    return {
+        "filtros": filtros,
+        "registros": len(calificados),
+        "sin_calificacion": len(sub) - len(calificados),
+        "alumnos": int(calificados["Matricula"].nunique()),
+        "promedio": numero_json(cal.mean(), 2),
+        "minima": numero_json(cal.min()),
+        "maxima": numero_json(cal.max()),
+        "reprobados": int((cal < CALIFICACION_APROBATORIA).sum()),
+    }
+
+def herramienta_calificaciones(d: DatosAcademicos, materia=None, profesor=None, carrera=None,
+                               cuatrimestre=None, minima=None, maxima=None, limite=20, fuente=None):
+    sub, filtros = filtrar_registros(d, materia, profesor, carrera, cuatrimestre, fuente)
+    if sub is None:
+        return filtros
+    if minima is not None:
+        sub = sub[sub["Calificacion"] >= float(minima)]
+    if maxima is not None:
+        sub = sub[sub["Calificacion"] <= float(maxima)]
+    limite = max(1, min(int(limite or 20), 50))
+    return {
+        "filtros": filtros,
+        "total": len(sub),
+        "registros": [
+            {"matricula": normalizar_matricula(m), "alumno": n, "materia": ma,
+             "calificacion": numero_json(c), "profesor": p, "cuatrimestre": int(cu)}
+            for m, n, ma, c, p, cu in zip(
+                sub["Matricula"][:limite], sub["Nombre_Completo"][:limite], sub["Materia"][:limite],
+                sub["Calificacion"][:limite], sub["Profesor"][:limite], sub["Cuatrimestre"][:limite]
+            )
+        ],
+    }
+
+PARAMETROS_FILTRO = {
+    "materia": {"type": "string", "description": "Nombre (o parte) de la materia"},
+    "profesor": {"type": "string", "description": "Nombre (o parte) del profesor"},
+    "carrera": {"type": "string", "description": "Nombre o clave de la carrera, p. ej. ITI"},
+    "cuatrimestre": {"type": "integer", "description": "Número de cuatrimestre"},
+    "fuente": {"type": "string", "description": "Exportación (campus/periodo) de la que provienen los registros"},
+}
+
+HERRAMIENTAS = {
+    "alumno_por_matricula": (herramienta_alumno, {
+        "description": "Datos generales y calificaciones de un alumno por su matrícula.",
+        "parameters": {
+            "type": "object",
+            "properties": {"matricula": {"type": "string"}},
+            "required": ["matricula"],
+        },
+    }),
+    "buscar_profesor": (herramienta_profesor, {
+        "description": "Perfil de profesores: materias, carreras, cuatrimestres, promedio y alumnos.",
+        "parameters": {
+            "type": "object",
+            "properties": {"nombre": {"type": "string"}},
+            "required": ["nombre"],
+        },
+    }),
+    "promedio_calificaciones": (herramienta_promedio, {
+        "description": "Promedio, mínima, máxima y reprobados de las calificaciones filtradas; "
+                       "los registros sin calificación se cuentan aparte.",
+        "parameters": {"type": "object", "properties": PARAMETROS_FILTRO},
+    }),
+    "listar_calificaciones": (herramienta_calificaciones, {
+        "description": "Registros de calificaciones filtrados, con rango opcional de calificación.",
+        "parameters": {
+            "type": "object",
+            "properties": dict(
+                PARAMETROS_FILTRO,
+                minima={"type": "number"},
+                maxima={"type": "number"},
+                limite={"type": "integer", "description": "Máximo de registros (1-50)"},
+            ),
+        },
+    }),
+}
+
+DEFINICIONES_HERRAMIENTAS = [
+    {"type": "function", "function": dict(definicion, name=nombre)}
+    for nombre, (_, definicion) in HERRAMIENTAS.items()
+]
+
+def ejecutar_herramienta(d: DatosAcademicos, nombre, argumentos):
+    if nombre not in HERRAMIENTAS:
+        return {"error": f"Herramienta desconocida: {nombre}"}
+    try:
+        kwargs = json.loads(argumentos or "{}")
+        return HERRAMIENTAS[nombre][0](d, **kwargs)
+    except Exception as e:
+        logger.warning("Error en herramienta %s: %s", nombre, e)
+        return {"error": str(e)}
+
+async def completar_con_herramientas(d: DatosAcademicos, messages):
+    """
+    Ofrece las herramientas al modelo y ejecuta localmente las que pida,
+    hasta que responda o se agoten OPENAI_TOOL_ROUNDS rondas.
+    """
+    messages = list(messages)
+    for ronda in range(OPENAI_TOOL_ROUNDS + 1):
+        ultima = ronda == OPENAI_TOOL_ROUNDS
+        response = await completar_chat(
+            messages=messages,
+            temperature=0.3,
+            max_tokens=800,
+            top_p=0.9,
+            tools=DEFINICIONES_HERRAMIENTAS,
+            tool_choice="none" if ultima else "auto"
+        )
+        mensaje = response.choices[0].message
+        if not mensaje.tool_calls or ultima:
+            return (mensaje.content or "").strip()
+        messages.append({
+            "role": "assistant",
+            "content": mensaje.content,
+            "tool_calls": [
+                {"id": tc.id, "type": "function",
+                 "function": {"name": tc.function.name, "arguments": tc.function.arguments}}
+                for tc in mensaje.tool_calls
+            ],
+        })
+        for tc in mensaje.tool_calls:
+            resultado = ejecutar_herramienta(d, tc.function.name, tc.function.arguments)
+            logger.info("Herramienta %s(%s)", tc.function.name, tc.function.arguments)
+            messages.append({
+                "role": "tool",
+                "tool_call_id": tc.id,
+                "content": json.dumps(resultado, ensure_ascii=False, default=str),
+            })
+
+# ─── CACHÉ DE RESPUESTAS ─────────────────────────────────────────
+MENSAJE_INICIO = "Nueva conversación iniciada"
+# Consultas que retoman la conversación: "¿y su promedio?", "¿por qué?", "lo mismo en ITI"
+PATRON_SEGUIMIENTO = re.compile(
+    r"^(?:y|e|o|pero|entonces|tambien|ademas)\b"
+    r"|\b(?:su|sus|suyo|suya|ella|ellos|ellas|eso|esa|ese|esos|esas|aquel|aquella"
+    r"|anterior|anteriores|mismo|misma|mismos|mismas|dicho|dicha)\b"
+)
+
+def historial_vigente(historial):
+    """Mensajes de la conversación actual: lo posterior al último /start, sin mensajes de sistema."""
+    for i in range(len(historial) - 1, -1, -1):
+        if historial[i].get("role") == "system":
+            historial = historial[i + 1:]
+            break
+    return [msg for msg in historial if msg.get("role") != "system"]
+
+def es_consulta_autonoma(consulta) -> bool:
+    """True si la consulta se entiende sin la conversación previa."""
+    palabras = re.findall(r"\w+", normalizar_consulta(consulta))
+    return len(palabras) >= 3 and not PATRON_SEGUIMIENTO.search(" ".join(palabras))
+
+def huella_historial(historial) -> str:
+    """Resumen del historial que entra al prompt; "" si no hay historial."""
+    if not historial:
+        return ""
+    contenido = json.dumps([(msg["role"], msg["content"]) for msg in historial], ensure_ascii=False)
+    return hashlib.sha1(contenido.encode("utf-8")).hexdigest()
+
+class CacheRespuestas:
+    """
+    Caché LRU con caducidad de respuestas del modelo, por consulta normalizada,
+    versión de los datos y huella del historial incluido en el prompt (vacía
+    para las consultas autónomas, que se comparten entre usuarios). Se vacía
+    al recargar el CSV.
+    """
+    def __init__(self, max_items=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clave(self, consulta, version, historial=""):
+        return (version, normalizar_consulta(consulta), historial)
+
+    def obtener(self, clave):
+        item = self.items.get(clave)
+        if item is not None and time.monotonic() - item[0] <= self.ttl:
+            self.items.move_to_end(clave)
+            self.hits += 1
+            return item[1]
+        if item is not None:
+            del self.items[clave]
+        self.misses += 1
+        return None
+
+    def guardar(self, clave, respuesta):
+        if self.max_items <= 0:
+            return
+        self.items[clave] = (time.monotonic(), respuesta)
+        self.items.move_to_end(clave)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def invalidar(self):
+        self.items.clear()
+
+    def estadisticas(self):
+        total = self.hits + self.misses
+        return {
+            "items": len(self.items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+cache_respuestas = CacheRespuestas()
+
+# ─── CONSULTAS EN VUELO Y LÍMITE POR USUARIO ─────────────────────
+class VueloUnico:
+    """
+    Une las llamadas concurrentes con la misma clave en una sola ejecución:
+    la primera la lanza como tarea propia y las demás esperan su resultado.
+    Si quien la lanzó se cancela, la tarea sigue para los demás.
+
+    `fabrica(avisar)` recibe una función que reparte el progreso entre los
+    `oyente` de quienes esperan en ese momento (cada uno, p. ej., con su propio
+    mensaje en edición); la falla de un oyente no afecta a la ejecución ni a
+    los demás.
+    """
+    def __init__(self):
+        self.en_curso = {}  # clave -> (tarea, oyentes)
+        self.compartidas = 0
+
+    def en_vuelo(self, clave) -> bool:
+        return clave in self.en_curso
+
+    async def ejecutar(self, clave, fabrica, oyente=None):
+        entrada = self.en_curso.get(clave)
+        if entrada is None:
+            oyentes = []
+            tarea = asyncio.ensure_future(fabrica(functools.partial(self._avisar, oyentes)))
+            entrada = self.en_curso[clave] = (tarea, oyentes)
+            tarea.add_done_callback(lambda t: self._terminar(clave, t))
+        else:
+            self.compartidas += 1
+            metricas.incrementar("consultas_compartidas_total")
+        tarea, oyentes = entrada
+        if oyente is not None:
+            oyentes.append(oyente)
+        try:
+            return await asyncio.shield(tarea)
+        finally:
+            if oyente is not None:
+                oyentes.remove(oyente)
+
+    @staticmethod
+    async def _avisar(oyentes, texto):
+        resultados = await asyncio.gather(*(oyente(texto) for oyente in list(oyentes)),
+                                          return_exceptions=True)
+        for resultado in resultados:
+            if isinstance(resultado, Exception):
+                logger.warning("Progreso de una consulta compartida no enviado: %s", resultado)
+
+    def _terminar(self, clave, tarea):
+        if self.en_curso.get(clave, (None,))[0] is tarea:
+            del self.en_curso[clave]
+        if not tarea.cancelled():
+            # Evita el aviso de excepción no recuperada si nadie quedó esperando
+            tarea.exception()
+
+class LimitadorUsuarios:
+    """
+    Token bucket por usuario: hasta `rafaga` consultas seguidas y después
+    `por_minuto` por minuto. Recuerda a los `max_usuarios` más recientes; uno
+    olvidado vuelve con la cubeta llena.
+    """
+    def __init__(self, por_minuto=RATE_LIMIT_PER_MINUTE, rafaga=RATE_LIMIT_BURST, max_usuarios=10000):
+        self.tasa = por_minuto / 60
+        self.rafaga = max(1, rafaga)
+        self.max_usuarios = max_usuarios
+        self.cubetas = OrderedDict()  # user_id -> (fichas, instante)
+        self.rechazadas = 0
+
+    def consumir(self, user_id) -> float:
+        """0 si la consulta se permite; si no, segundos hasta la próxima ficha."""
+        if self.tasa <= 0:
+            return 0.0
+        ahora = time.monotonic()
+        fichas, antes = self.cubetas.pop(user_id, (self.rafaga, ahora))
+        fichas = min(self.rafaga, fichas + (ahora - antes) * self.tasa)
+        if fichas >= 1:
+            fichas -= 1
+            espera = 0.0
+        else:
+            espera = (1 - fichas) / self.tasa
+            self.rechazadas += 1
+            metricas.incrementar("consultas_limitadas_total")
+        self.cubetas[user_id] = (fichas, ahora)
+        if len(self.cubetas) > self.max_usuarios:
+            self.cubetas.popitem(last=False)
+        return espera
+
+vuelo_unico = VueloUnico()
+limitador = LimitadorUsuarios()
+
+# ─── PRESUPUESTO DE TOKENS DEL PROMPT ────────────────────────────
+def estimar_tokens(texto: str) -> int:
+    """Estimación rápida (~4 caracteres por token) sin depender de un tokenizador."""
+    return (len(texto) + 3) // 4
+
+class SeccionPrompt:
+    """
+    Parte del prompt. Las secciones con `items` se recortan de a un elemento
+    (desde el principio de la lista) cuando el prompt excede el presupuesto;
+    `prioridad` más baja se recorta antes y None nunca se recorta.
+    """
+    def __init__(self, nombre, titulo, items, prioridad=None, vacio="Ninguno"):
+        self.nombre = nombre
+        self.titulo = titulo
+        self.items = list(items)
+        self.prioridad = prioridad
+        self.vacio = vacio
+
+    def texto(self):
+        cuerpo = "\n".join(self.items) if self.items else self.vacio
+        return f"{self.titulo}{cuerpo}"
+
+def ajustar_a_presupuesto(secciones, presupuesto):
+    """Recorta las secciones recortables hasta que el total estimado quepa en el presupuesto."""
+    recortables = sorted(
+        (sec for sec in secciones if sec.prioridad is not None),
+        key=lambda sec: sec.prioridad
+    )
+    total = sum(estimar_tokens(sec.texto()) for sec in secciones)
+    for sec in recortables:
+        while total > presupuesto and sec.items:
+            antes = estimar_tokens(sec.texto())
+            sec.items.pop(0)
+            total -= antes - estimar_tokens(sec.texto())
+    if total > presupuesto:
+        logger.warning("Prompt de ~%d tokens excede el presupuesto de %d", total, presupuesto)
+    return total
+
+def construir_system_prompt(d: DatosAcademicos, historial, conocimiento_relacionado,
+                            con_ejemplos=True, presupuesto=PROMPT_TOKEN_BUDGET):
+    """
+    Arma el prompt de sistema dentro de `presupuesto` tokens (estimados):
+    primero se descarta el conocimiento menos relevante, luego el historial
+    más antiguo y por último los ejemplos. Devuelve (prompt, tokens por sección).
+    """
+    # Resumen estadístico (precalculado para la versión actual de los datos)
+    resumen = d.perfil_dataset["resumen"]
     
-    # Agrupar por profesor (CORRECCIÓN: USAR SOLO DATOS DE PROFESORES)
-    profesor_info = resultados.groupby('Profesor').agg({
-        'Materia': lambda x: list(set(x)),
-        'Calificacion': 'mean',
-        'Carrera': lambda x: list(set(x)),
-        'Cuatrimestre': lambda x: list(set(x))
-    }).reset_index()
-    
-    profesor_info.columns = ['Profesor', 'Materias', 'Promedio_Calificaciones', 'Carreras', 'Cuatrimestres']
+    instrucciones = (
+        "Eres un asistente académico especializado en datos educativos. "
+        "Datos importantes:\n"
+        "1. Los alumnos tienen: Matrícula, Nombre (Nombre + Paterno + Materno), Carrera, Promedio\n"
+        "2. Los profesores están en la columna 'Profesor' y se relacionan con materias y alumnos\n"
+        "3. Cada registro representa un alumno en una materia con un profesor\n\n"
+        f"Resumen estadístico:\n{resumen}\n\n"
+        "Estructura de datos:\n"
+        "- Carrera: Nombre completo de la carrera\n"
+        "- Matricula: Identificador único del alumno\n"
+        "- Nombre, Paterno, Materno: Componentes del nombre ALUMNO\n"
+        "- Materia: Nombre completo de la materia\n"
+        "- Calificacion: Valor numérico (0-10)\n"
+        "- Cuatrimestre: Periodo académico\n"
+        "- Profesor: Nombre del DOCENTE (columna específica para profesores)\n"
+        "- Género: M/F\n"
+        "- Fuente: Exportación (campus/periodo) de la que proviene el registro"
+    )
+    # get_related_knowledge devuelve primero lo más relevante: se recorta desde el final
+    conocimiento = [
+        json.dumps({clave: valor}, ensure_ascii=False, default=str)
+        for clave, valor in reversed(list(conocimiento_relacionado.items()))
+    ]
+    secciones = [
+        SeccionPrompt("instrucciones", "", [instrucciones]),
+        SeccionPrompt("conocimiento", "\n\nConocimiento relacionado:\n", conocimiento, prioridad=1),
+        SeccionPrompt("historial", "\n\nHistorial:\n",
+                      [f"{msg['role']}: {msg['content']}" for msg in historial], prioridad=2, vacio=""),
+    ]
     
-    # Obtener cantidad de alumnos (sin detalles personales)
-    profesor_info['Cantidad_Alumnos'] = resultados['Matricula'].nunique()
+    if con_ejemplos:
+        # Ejemplos de datos
+        ejemplos = []
+        sample_data = d.df.sample(min(5, len(d.df)))
+        for _, row in sample_data.iterrows():
+            ejemplos.append(
+                f"- Alumno: {row['Nombre_Completo']} | "
+                f"Materia: {row['Materia']} ({row['Calificacion']}) | "
+                f"Profesor: {row['Profesor']} | "
+                f"Carrera: {row['Carrera']} | "
+                f"Cuatri: {row['Cuatrimestre']}"
+            )
+        secciones.append(SeccionPrompt("ejemplos", "\n\nEjemplos de registros:\n", ejemplos, prioridad=3, vacio=""))
+    else:
+        secciones.append(SeccionPrompt("herramientas", "\n\n", [
+            "No inventes datos: consulta los registros reales con las herramientas "
+            "disponibles antes de responder sobre alumnos, profesores o materias."
+        ]))
     
-    return profesor_info
+    total = ajustar_a_presupuesto(secciones, presupuesto)
+    tokens = {sec.nombre: estimar_tokens(sec.texto()) for sec in secciones}
+    tokens["total"] = total
+    return "".join(sec.texto() for sec in secciones), tokens
+
+def formatear_respuesta_ia(consulta, respuesta):
+    # Manejo de respuestas sin datos
+    if "no tengo información" in respuesta.lower() or "no hay datos" in respuesta.lower():
+        return f"🔍 No encontré datos para: '{consulta}'\n\n" \
+               "ℹ️ Prueba con:\n- Matrícula (ej: 23070045)\n- Nombre completo alumno\n- Nombre profesor\n- 'Lista de profesores'"
+    return respuesta
 
 # ─── IA: PROCESAMIENTO DE CONSULTAS CON MEMORIA ─────────────────
-async def procesar_consulta_ia(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if df.empty:
+async def procesar_consulta_ia(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                               progreso: RespuestaProgresiva = None):
+    d = datos
+    if d.df.empty:
+        metricas.incrementar("bot_consultas_ia_total", resultado="sin_datos")
         return "⚠️ Base de datos no disponible. Intente más tarde."
     
-    if not client:
-        return "🔴 Error: API Key de OpenAI no configurada"
-    
     user_id = update.message.from_user.id
     consulta = update.message.text.strip()
     
+    # Preguntas de agregación/filtrado: respuesta exacta sin el modelo
+    respuesta = responder_consulta_local(d, consulta)
+    if respuesta is not None:
+        metricas.incrementar("bot_consultas_ia_total", resultado="local")
+        return respuesta
+    
     # Primero verificar si es una consulta directa de profesor
     if "profesor" in consulta.lower() or "docente" in consulta.lower():
         # Extraer nombre de profesor
         match = re.search(r'(profesor|docente)\s+([\w\s]+)', consulta, re.IGNORECASE)
         if match:
             nombre_profesor = match.group(2).strip()
-            profesor_info = buscar_profesor(nombre_profesor)
+            profesor_info = d.buscar_profesor(nombre_profesor)
             if profesor_info is not None:
                 respuesta = []
-                for _, row in profesor_info.iterrows():
+                for row in profesor_info:
                     respuesta.append(
                         f"👨‍🏫 *Profesor: {row['Profesor']}*\n"
                         f"📚 Materias: {', '.join(row['Materias'][:3])}{'...' if len(row['Materias']) > 3 else ''}\n"
@@ -205,125 +2263,192 @@ async def procesar_consulta_ia(update: Update, context: ContextTypes.DEFAULT_TYP
                         f"⭐ Promedio calificaciones: {row['Promedio_Calificaciones']:.2f}\n"
                         f"👥 Alumnos: {row['Cantidad_Alumnos']}"
                     )
+                metricas.incrementar("bot_consultas_ia_total", resultado="profesor")
                 return "\n\n".join(respuesta)
     
+    if not client:
+        metricas.incrementar("bot_consultas_ia_total", resultado="sin_cliente")
+        return "🔴 Error: API Key de OpenAI no configurada"
+    
+    # Las consultas autónomas no llevan historial y se comparten entre usuarios;
+    # las que retoman la conversación ("¿y su promedio?") se distinguen por él
+    historial = []
+    if not es_consulta_autonoma(consulta):
+        historial = historial_vigente(memory_system.get_conversation_history(user_id))
+    clave = cache_respuestas.clave(consulta, d.version, huella_historial(historial))
+    
+    # Pregunta repetida: se responde desde la caché sin llamar al modelo
+    respuesta = cache_respuestas.obtener(clave)
+    if respuesta is not None:
+        memory_system.update_conversation(user_id, "user", consulta)
+        memory_system.update_conversation(user_id, "assistant", respuesta)
+        metricas.incrementar("bot_consultas_ia_total", resultado="cache")
+        return formatear_respuesta_ia(consulta, respuesta)
+    
+    if progreso is not None and not OPENAI_TOOLS:
+        # Mensaje provisional propio de este usuario, fuera de la llamada compartida
+        await progreso.iniciar()
+    
+    # Sumarse a una llamada ya en curso no consume del límite: sólo las llamadas nuevas
+    espera = 0 if vuelo_unico.en_vuelo(clave) else limitador.consumir(user_id)
+    if espera:
+        metricas.incrementar("bot_consultas_ia_total", resultado="limitada")
+        return (
+            "⏳ Estás enviando muchas consultas seguidas. "
+            f"Intenta de nuevo en {math.ceil(espera)} s."
+        )
+    
     # Si no es una consulta directa de profesor, usar IA
     memory_system.update_conversation(user_id, "user", consulta)
-    historial = memory_system.get_conversation_history(user_id)
-    conocimiento_relacionado = memory_system.get_related_knowledge(consulta)
-    
-    # Resumen estadístico
-    resumen = (
-        f"Dataset con {len(df)} registros. "
-        f"Carreras: {df['Carrera'].nunique()}, "
-        f"Materias: {df['Materia'].nunique()}, "
-        f"Profesores: {df['Profesor'].nunique()}, "
-        f"Alumnos: {df['Matricula'].nunique()}. "
-        f"Calificaciones: Min {df['Calificacion'].min():.1f}, "
-        f"Max {df['Calificacion'].max():.1f}, "
-        f"Avg {df['Calificacion'].mean():.1f}."
-    )
     
-    # Ejemplos de datos
-    ejemplos = []
-    sample_data = df.sample(min(5, len(df)))
-    for _, row in sample_data.iterrows():
-        ejemplos.append(
-            f"- Alumno: {row['Nombre_Completo']} | "
-            f"Materia: {row['Materia']} ({row['Calificacion']}) | "
-            f"Profesor: {row['Profesor']} | "
-            f"Carrera: {row['Carrera']} | "
-            f"Cuatri: {row['Cuatrimestre']}"
+    try:
+        # Misma pregunta (con el mismo contexto) en curso para otro usuario: se comparte esa llamada
+        respuesta = await vuelo_unico.ejecutar(
+            clave,
+            lambda avisar: consultar_modelo(d, consulta, historial, clave,
+                                            avisar if OPENAI_STREAM else None),
+            oyente=progreso.actualizar if progreso is not None else None
         )
+    except Exception as e:
+        logger.error(f"Error en IA: {str(e)}")
+        metricas.incrementar("bot_consultas_ia_total", resultado="error")
+        return "🔴 Error procesando la consulta. Intente reformular."
     
-    # Prompt optimizado
-    system_prompt = (
-        "Eres un asistente académico especializado en datos educativos. "
-        "Datos importantes:\n"
-        "1. Los alumnos tienen: Matrícula, Nombre (Nombre + Paterno + Materno), Carrera, Promedio\n"
-        "2. Los profesores están en la columna 'Profesor' y se relacionan con materias y alumnos\n"
-        "3. Cada registro representa un alumno en una materia con un profesor\n\n"
-        f"Resumen estadístico:\n{resumen}\n\n"
-        "Estructura de datos:\n"
-        "- Carrera: Nombre completo de la carrera\n"
-        "- Matricula: Identificador único del alumno\n"
-        "- Nombre, Paterno, Materno: Componentes del nombre ALUMNO\n"
-        "- Materia: Nombre completo de la materia\n"
-        "- Calificacion: Valor numérico (0-10)\n"
-        "- Cuatrimestre: Periodo académico\n"
-        "- Profesor: Nombre del DOCENTE (columna específica para profesores)\n"
-        "- Género: M/F\n\n"
-        "Conocimiento relacionado:\n" +
-        (json.dumps(conocimiento_relacionado, ensure_ascii=False) if conocimiento_relacionado else "Ninguno") +
-        "\n\nHistorial:\n" +
-        "\n".join([f"{msg['role']}: {msg['content']}" for msg in historial]) +
-        "\n\nEjemplos de registros:\n" + 
-        '\n'.join(ejemplos)
+    memory_system.update_conversation(user_id, "assistant", respuesta)
+    metricas.incrementar("bot_consultas_ia_total", resultado="modelo")
+    return formatear_respuesta_ia(consulta, respuesta)
+
+async def consultar_modelo(d: DatosAcademicos, consulta, historial, clave, al_progresar=None):
+    """
+    Una llamada (o ronda de herramientas) al modelo; guarda la respuesta en la
+    caché bajo `clave`. Con `al_progresar` la respuesta se pide en modo stream.
+    """
+    conocimiento_relacionado = memory_system.get_related_knowledge(consulta)
+    
+    system_prompt, tokens_prompt = construir_system_prompt(
+        d, historial, conocimiento_relacionado, con_ejemplos=not OPENAI_TOOLS
     )
+    logger.info("Prompt de sistema: ~%d tokens estimados %s", tokens_prompt["total"], tokens_prompt)
     
-    try:
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": consulta}
-        ]
-        
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": consulta}
+    ]
+    
+    if OPENAI_TOOLS:
+        respuesta = await completar_con_herramientas(d, messages)
+    elif al_progresar is not None:
+        respuesta = (await transmitir_chat(
+            al_progresar,
+            messages=messages,
+            temperature=0.3,
+            max_tokens=800,
+            top_p=0.9
+        )).strip()
+    else:
+        response = await completar_chat(
             messages=messages,
             temperature=0.3,
             max_tokens=800,
             top_p=0.9
         )
         respuesta = response.choices[0].message.content.strip()
-        memory_system.update_conversation(user_id, "assistant", respuesta)
-        
-        # Extraer y guardar entidades
-        try:
-            self_update_prompt = (
-                "Analiza la interacción y extrae entidades importantes: "
-                "alumnos (por matrícula), profesores (por nombre), materias, carreras. "
-                "Devuelve JSON con estructura: "
-                "{'alumnos': {matricula: {data}}, 'profesores': {nombre: {data}}, 'materias': {nombre: {data}}, 'carreras': {nombre: {data}}}"
-                f"\n\nConsulta: {consulta}\nRespuesta: {respuesta}"
-            )
-            
-            update_response = client.chat.completions.create(
-                model="gpt-3.5-turbo-1106",
-                messages=[
-                    {"role": "system", "content": "Eres un extractor de información especializado"},
-                    {"role": "user", "content": self_update_prompt}
-                ],
-                temperature=0.1,
-                max_tokens=500,
-                response_format={"type": "json_object"}
-            )
-            entities = json.loads(update_response.choices[0].message.content)
-            
-            for entity_type, items in entities.items():
-                for entity_id, data in items.items():
-                    if 'keywords' not in data:
-                        data['keywords'] = []
-                    data['keywords'].extend(re.findall(r'\b\w+\b', entity_id.lower()))
-                    data['keywords'].extend(re.findall(r'\b\w+\b', data.get('nombre', '').lower()))
-                    memory_system.update_knowledge(entity_type, entity_id, data)
-        except Exception as e:
-            logger.error(f"Error actualizando conocimiento: {str(e)}")
-        
-        # Manejo de respuestas sin datos
-        if "no tengo información" in respuesta.lower() or "no hay datos" in respuesta.lower():
-            return f"🔍 No encontré datos para: '{consulta}'\n\n" \
-                   "ℹ️ Prueba con:\n- Matrícula (ej: 23070045)\n- Nombre completo alumno\n- Nombre profesor\n- 'Lista de profesores'"
-                   
-        return respuesta
+    cache_respuestas.guardar(clave, respuesta)
     
-    except Exception as e:
-        logger.error(f"Error en IA: {str(e)}")
-        return "🔴 Error procesando la consulta. Intente reformular."
+    # Extraer entidades fuera del camino crítico de la respuesta
+    extractor.encolar(consulta, respuesta)
+    return respuesta
+
+# ─── RESPUESTAS PROGRESIVAS ──────────────────────────────────────
+LIMITE_MENSAJE = 4096
+
+class RespuestaProgresiva:
+    """
+    Mensaje de Telegram que se edita a medida que llega la respuesta del
+    modelo, como máximo una vez cada `intervalo` segundos (límite de ediciones
+    de Telegram). Las ediciones intermedias son de mejor esfuerzo; `finalizar`
+    deja el texto definitivo, reintentando tras un RetryAfter y, si no se puede
+    editar, enviándolo como mensaje nuevo.
+    """
+    def __init__(self, message, intervalo=STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.intervalo = intervalo
+        self.enviado = None
+        self.ultimo_texto = ""
+        self.proxima_edicion = 0.0
+
+    async def iniciar(self):
+        try:
+            self.enviado = await self.message.reply_text("✍️ ...")
+        except TelegramError as e:
+            # Sin mensaje provisional la respuesta se envía completa al final
+            logger.warning("No se pudo enviar el mensaje provisional: %s", e)
+            return
+        self.proxima_edicion = time.monotonic() + self.intervalo
+
+    async def _editar(self, texto):
+        try:
+            await self.enviado.edit_text(texto)
+            self.ultimo_texto = texto
+        except RetryAfter as e:
+            self.proxima_edicion = time.monotonic() + float(e.retry_after)
+        except TelegramError as e:
+            # "Message is not modified", TimedOut, NetworkError...: la siguiente edición lo corrige
+            logger.debug("Edición omitida: %s", e)
+
+    async def _editar_final(self, texto, intentos=2) -> bool:
+        for intento in range(intentos):
+            try:
+                await self.enviado.edit_text(texto)
+                self.ultimo_texto = texto
+                return True
+            except RetryAfter as e:
+                if intento + 1 < intentos:
+                    await asyncio.sleep(float(e.retry_after))
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return True
+                logger.warning("Edición final fallida: %s", e)
+                return False
+            except TelegramError as e:
+                logger.warning("Edición final fallida: %s", e)
+        return False
+
+    async def actualizar(self, texto):
+        if self.enviado is None or time.monotonic() < self.proxima_edicion:
+            return
+        texto = texto[:LIMITE_MENSAJE - 2].strip()
+        if not texto or texto == self.ultimo_texto:
+            return
+        self.proxima_edicion = time.monotonic() + self.intervalo
+        await self._editar(texto + " ▌")
+
+    async def finalizar(self, texto):
+        partes = [texto[i:i + LIMITE_MENSAJE] for i in range(0, len(texto), LIMITE_MENSAJE)] or [texto]
+        if partes[0] != self.ultimo_texto and not await self._editar_final(partes[0]):
+            # El provisional quedó con texto parcial: se quita y se envía la respuesta aparte
+            try:
+                await self.enviado.delete()
+            except TelegramError as e:
+                logger.debug("No se pudo borrar el mensaje provisional: %s", e)
+            await self.message.reply_text(partes[0])
+        for parte in partes[1:]:
+            await self.message.reply_text(parte)
+
+async def responder_con_ia(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Responde con procesar_consulta_ia; en modo stream edita un mensaje provisional."""
+    progreso = RespuestaProgresiva(update.message) if OPENAI_STREAM else None
+    respuesta = await procesar_consulta_ia(update, context, progreso)
+    if progreso is not None and progreso.enviado is not None:
+        await progreso.finalizar(respuesta)
+    else:
+        await update.message.reply_text(respuesta)
 
 # ─── HANDLERS ────────────────────────────────────────────────────
+@instrumentado("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    memory_system.update_conversation(user_id, "system", "Nueva conversación iniciada")
+    memory_system.update_conversation(user_id, "system", MENSAJE_INICIO)
     
     await update.message.reply_text(
         "🎓 *Sistema Académico Inteligente*\n\n"
@@ -341,13 +2466,57 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
+def es_admin(update: Update) -> bool:
+    return str(update.effective_user.id) in ADMIN_IDS
+
+@instrumentado("recargar")
+async def recargar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not es_admin(update):
+        await update.message.reply_text("⛔ Comando sólo para administradores.")
+        return
+    await update.message.reply_text("🔄 Recargando datos...")
+    if await recargar_datos(forzar=True):
+        await update.message.reply_text(
+            f"✅ Datos recargados (versión {datos.version}, {len(datos.df)} registros)."
+        )
+    else:
+        await update.message.reply_text(
+            f"⚠️ No se pudo recargar; se mantienen los datos de la versión {datos.version}."
+        )
+
+@instrumentado("stats")
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not es_admin(update):
+        await update.message.reply_text("⛔ Comando sólo para administradores.")
+        return "denegado"
+    await update.message.reply_text(texto_estadisticas())
+    return "ok"
+
+async def mostrar_alumno(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                         d: DatosAcademicos, r):
+    """Envía la tarjeta del alumno de la fila `r` y la registra en la memoria."""
+    mat = normalizar_matricula(r["Matricula"])
+    context.user_data["matricula"] = mat
+    resumen, kb = d.vista_alumno(mat, "general")
+    await update.message.reply_text(resumen, parse_mode="Markdown", reply_markup=kb)
+    
+    # Actualizar conocimiento
+    memory_system.update_knowledge("alumnos", mat, {
+        "nombre": f"{r['Nombre']} {r.get('Paterno','')} {r.get('Materno','')}",
+        "carrera": r.get('Carrera','N/A'),
+        "promedio": round(float(r.get('Promedio_General', float('nan'))), 2),
+        "keywords": [mat, r['Nombre'].lower(), r.get('Paterno','').lower()]
+    })
+
+@instrumentado("buscar")
 async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     texto = update.message.text.strip()
     user_id = update.message.from_user.id
+    d = datos
     
     # Comandos especiales para profesores
     if texto.lower() in ["profesores", "lista de profesores", "docentes"]:
-        profesores = df["Profesor"].dropna().unique()
+        profesores = d.df["Profesor"].dropna().unique() if "Profesor" in d.df else []
         if len(profesores) > 0:
             respuesta = "👨‍🏫 *Lista de profesores:*\n\n" + "\n".join(f"- {p}" for p in profesores[:20])
             if len(profesores) > 20:
@@ -355,15 +2524,15 @@ async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(respuesta, parse_mode="Markdown")
         else:
             await update.message.reply_text("No se encontraron profesores en la base de datos.")
-        return
+        return "lista_profesores"
     
     # Búsqueda directa de profesor (CORRECCIÓN: SEPARADO DE ALUMNOS)
     if texto.lower().startswith(("profesor ", "docente ")):
         nombre_prof = texto.split(" ", 1)[1].strip()
-        profesor_info = buscar_profesor(nombre_prof)
+        profesor_info = d.buscar_profesor(nombre_prof)
         if profesor_info is not None:
             respuesta = []
-            for _, row in profesor_info.iterrows():
+            for row in profesor_info:
                 respuesta.append(
                     f"👨‍🏫 *Profesor: {row['Profesor']}*\n"
                     f"📚 *Materias que imparte:*\n{', '.join(row['Materias'][:5])}"
@@ -372,46 +2541,20 @@ async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"👥 *Alumnos:* {row['Cantidad_Alumnos']}"
                 )
             await update.message.reply_text("\n\n".join(respuesta), parse_mode="Markdown")
-            return
+            return "profesor"
         else:
             await update.message.reply_text(f"⚠️ No se encontró al profesor: {nombre_prof}")
-            return
+            return "profesor"
     
     # 1) Busca por matrícula (solo dígitos) - ALUMNOS
     if texto.isdigit():
-        sub = df[df["Matricula"].astype(str).str.strip() == texto]
+        sub = d.registros_por_matricula(texto)
         if not sub.empty:
-            r = sub.iloc[0]
-            mat = str(r["Matricula"]).strip()
-            context.user_data["matricula"] = mat
-
-            resumen = (
-                f"👤 *Alumno: {r['Nombre']} {r.get('Paterno','')} {r.get('Materno','')}*\n"
-                f"🎓 Carrera: {r.get('Carrera','N/A')}\n"
-                f"🔢 Matrícula: {mat}\n"
-                f"⭐ Promedio general: {r.get('Promedio_General','N/A'):.2f}\n"
-                f"📅 Cuatrimestre: {r.get('Cuatrimestre','N/A')}"
-            )
-            kb = InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("📊 Ver calificaciones", callback_data=f"grades|{mat}"),
-                    InlineKeyboardButton("🔄 Consultar otro", callback_data="back")
-                ]
-            ])
-            await update.message.reply_text(resumen, parse_mode="Markdown", reply_markup=kb)
-            
-            # Actualizar conocimiento
-            memory_system.update_knowledge("alumnos", mat, {
-                "nombre": f"{r['Nombre']} {r.get('Paterno','')} {r.get('Materno','')}",
-                "carrera": r.get('Carrera','N/A'),
-                "promedio": r.get('Promedio_General','N/A'),
-                "keywords": [mat, r['Nombre'].lower(), r.get('Paterno','').lower()]
-            })
-            return
+            await mostrar_alumno(update, context, d, sub.iloc[0])
+            return "matricula"
         else:
-            respuesta = await procesar_consulta_ia(update, context)
-            await update.message.reply_text(respuesta)
-            return
+            await responder_con_ia(update, context)
+            return "ia"
 
     # 2) Busca por nombre completo (>= 3 palabras) - ALUMNOS
     partes = quitar_acentos(texto).lower().split()
@@ -420,55 +2563,20 @@ async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         paterno = partes[-2]
         nombres = " ".join(partes[:-2])
 
-        # Normalizar columnas
-        nombres_norm   = df["Nombre"].astype(str).apply(lambda x: quitar_acentos(x.lower()))
-        paternos_norm  = df["Paterno"].astype(str).apply(lambda x: quitar_acentos(x.lower()))
-        maternos_norm  = df["Materno"].astype(str).apply(lambda x: quitar_acentos(x.lower()))
-
-        mask = (
-            nombres_norm.str.contains(nombres, na=False) &
-            paternos_norm.str.contains(paterno, na=False) &
-            maternos_norm.str.contains(materno, na=False)
-        )
-        sub = df[mask]
+        sub = d.buscar_por_nombre(nombres, paterno, materno)
 
         if not sub.empty:
-            r = sub.iloc[0]
-            mat = str(r["Matricula"]).strip()
-            context.user_data["matricula"] = mat
-
-            resumen = (
-                f"👤 *Alumno: {r['Nombre']} {r.get('Paterno','')} {r.get('Materno','')}*\n"
-                f"🎓 Carrera: {r.get('Carrera','N/A')}\n"
-                f"🔢 Matrícula: {mat}\n"
-                f"⭐ Promedio general: {r.get('Promedio_General','N/A'):.2f}\n"
-                f"📅 Cuatrimestre: {r.get('Cuatrimestre','N/A')}"
-            )
-            kb = InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("📊 Ver calificaciones", callback_data=f"grades|{mat}"),
-                    InlineKeyboardButton("🔄 Consultar otro", callback_data="back")
-                ]
-            ])
-            await update.message.reply_text(resumen, parse_mode="Markdown", reply_markup=kb)
-            
-            # Actualizar conocimiento
-            memory_system.update_knowledge("alumnos", mat, {
-                "nombre": f"{r['Nombre']} {r.get('Paterno','')} {r.get('Materno','')}",
-                "carrera": r.get('Carrera','N/A'),
-                "promedio": r.get('Promedio_General','N/A'),
-                "keywords": [mat, r['Nombre'].lower(), r.get('Paterno','').lower()]
-            })
-            return
+            await mostrar_alumno(update, context, d, sub.iloc[0])
+            return "nombre"
         else:
-            respuesta = await procesar_consulta_ia(update, context)
-            await update.message.reply_text(respuesta)
-            return
+            await responder_con_ia(update, context)
+            return "ia"
 
     # 3) Consulta de IA con memoria
-    respuesta = await procesar_consulta_ia(update, context)
-    await update.message.reply_text(respuesta)
+    await responder_con_ia(update, context)
+    return "ia"
 
+@instrumentado("callback")
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -476,69 +2584,433 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 1) “Volver al inicio”
     if data == "back":
-        return await query.edit_message_text(
+        await query.edit_message_text(
             "✏️ Escribe *matrícula* o *nombre completo* de alumno, o *profesor ...*:",
             parse_mode="Markdown"
         )
+        return "back"
 
     # 2) Extraer acción y matrícula
     action, mat = data.split("|", 1)
-    sub = df[df["Matricula"].astype(str).str.strip() == mat]
-    if sub.empty:
-        return await query.edit_message_text("❌ Matrícula no encontrada.")
+    if action not in ("grades", "general"):
+        return "otro"
 
-    r = sub.iloc[0]
+    # 3) Calificaciones o datos generales (ALUMNOS), ya renderizados
+    vista = datos.vista_alumno(mat, action)
+    if vista is None:
+        await query.edit_message_text("❌ Matrícula no encontrada.")
+        return action
+    texto, kb = vista
+    await query.edit_message_text(texto, parse_mode="Markdown", reply_markup=kb)
+    return action
 
-    # 3) Mostrar calificaciones (ALUMNOS)
-    if action == "grades":
-        lines = ["📊 *Calificaciones por materia:*"]
-        for _, row in sub.iterrows():
-            matname = row.get("Materia", "N/A")
-            cal     = row.get("Calificacion", "N/A")
-            profesor = row.get("Profesor", "N/A")
-            lines.append(f"- {matname}: {cal} (Prof: {profesor})")
-        texto = "\n".join(lines)
-        kb = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("👤 Ver datos alumno", callback_data=f"general|{mat}"),
-                InlineKeyboardButton("🔄 Consultar otro", callback_data="back")
-            ]
-        ])
-        return await query.edit_message_text(texto, parse_mode="Markdown", reply_markup=kb)
-
-    # 4) Volver a datos generales (ALUMNOS)
-    if action == "general":
-        resumen = (
-            f"👤 *Alumno: {r['Nombre']} {r.get('Paterno','')} {r.get('Materno','')}*\n"
-            f"🎓 Carrera: {r.get('Carrera','N/A')}\n"
-            f"🔢 Matrícula: {mat}\n"
-            f"⭐ Promedio general: {r.get('Promedio_General','N/A'):.2f}\n"
-            f"📅 Cuatrimestre: {r.get('Cuatrimestre','N/A')}"
+# ─── EXPOSICIÓN DE MÉTRICAS ──────────────────────────────────────
+def actualizar_metricas_estado():
+    """Gauges que se leen del estado actual justo antes de exportar."""
+    for clave, valor in cache_respuestas.estadisticas().items():
+        metricas.fijar("cache_respuestas", valor, dato=clave)
+    metricas.fijar("extractor_cola", extractor.queue.qsize() if extractor.queue is not None else 0)
+
+def texto_estadisticas() -> str:
+    """Resumen legible de las métricas para el comando /stats."""
+    actualizar_metricas_estado()
+    valor = lambda nombre, **e: metricas.serie(nombre).get(tuple(sorted(e.items())), 0)
+    lineas = [
+        "📈 Estadísticas",
+        f"Datos: v{valor('datos_version'):g}, {valor('datos_registros'):g} registros, "
+        f"carga en {valor('datos_carga_segundos'):.2f} s",
+        "",
+        "Handlers (n · p50 · p95):",
+    ]
+    for clave, (_, _, n) in sorted(metricas.serie("bot_handler_segundos").items()):
+        etiquetas = dict(clave)
+        lineas.append(
+            f"- {etiquetas['handler']}/{etiquetas['rama']}: {n} · "
+            f"{metricas.cuantil('bot_handler_segundos', 0.5, clave) * 1000:.0f} ms · "
+            f"{metricas.cuantil('bot_handler_segundos', 0.95, clave) * 1000:.0f} ms"
         )
-        kb = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("📊 Ver calificaciones", callback_data=f"grades|{mat}"),
-                InlineKeyboardButton("🔄 Consultar otro", callback_data="back")
-            ]
-        ])
-        return await query.edit_message_text(resumen, parse_mode="Markdown", reply_markup=kb)
+    consultas = {dict(c)["resultado"]: int(v) for c, v in metricas.serie("bot_consultas_ia_total").items()}
+    if consultas:
+        lineas.append("Consultas IA: " + ", ".join(f"{k} {v}" for k, v in sorted(consultas.items())))
+    llamadas = metricas.serie("openai_llamadas_total")
+    errores = sum(v for c, v in llamadas.items() if dict(c)["resultado"] == "error")
+    lineas.append(
+        f"OpenAI: {sum(llamadas.values()):g} llamadas ({errores:g} errores), tokens "
+        f"{valor('openai_tokens_total', tipo='prompt'):g} de prompt / "
+        f"{valor('openai_tokens_total', tipo='respuesta'):g} de respuesta"
+    )
+    for clave, (_, suma, n) in sorted(metricas.serie("openai_segundos").items()):
+        lineas.append(f"- {dict(clave)['tipo']}: promedio {suma / n:.2f} s, "
+                      f"p95 {metricas.cuantil('openai_segundos', 0.95, clave):.2f} s")
+    guardados = metricas.serie("memoria_guardado_segundos").get((), ([], 0.0, 0))
+    lineas.append(
+        f"Memoria: {guardados[2]} guardados"
+        + (f", promedio {guardados[1] / guardados[2] * 1000:.1f} ms" if guardados[2] else "")
+        + f", {valor('memoria_archivo_bytes') / 1024:.1f} KB en disco"
+    )
+    cache = cache_respuestas.estadisticas()
+    lineas.append(
+        f"Caché de respuestas: {cache['hit_rate']:.0%} aciertos, {cache['items']} elementos | "
+        f"compartidas {vuelo_unico.compartidas}, limitadas {limitador.rechazadas}"
+    )
+    return "\n".join(lineas)
+
+async def atender_conexion_metricas(reader, writer):
+    try:
+        # Sólo se atienden GET: el cuerpo, si lo hay, no se lee
+        peticion = await leer_cabeceras_http(reader)
+        if peticion is not None:
+            metodo, ruta, _ = peticion
+            if metodo == "GET" and ruta == "/metrics":
+                actualizar_metricas_estado()
+                await responder_http(writer, 200, metricas.exportar().encode(),
+                                     "text/plain; version=0.0.4; charset=utf-8", mantener=False)
+            else:
+                await responder_http(writer, 404, mantener=False)
+    except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+# ─── ARRANQUE ─────────────────────────────────────────────────────
+def medir_fase(nombre, funcion):
+    inicio = time.perf_counter()
+    resultado = funcion()
+    logger.info("Arranque: %s en %.3f s", nombre, time.perf_counter() - inicio)
+    return resultado
+
+def inicializar(memoria_compartida=False):
+    """
+    Carga datos, memoria y cliente de OpenAI. Importar el módulo no hace
+    ninguna de estas tareas; se llaman aquí (o desde herramientas y pruebas)
+    de forma explícita y se registra cuánto tarda cada fase.
+    Con `memoria_compartida` la memoria va a la base SQLite común a todos los
+    workers del webhook y cada cambio se confirma de inmediato.
+    """
+    global datos, memory_system, client
+    inicio = time.perf_counter()
+    datos = medir_fase("datos", lambda: cargar_datos(CSV_PATH))
+    if memoria_compartida:
+        memory_system = medir_fase("memoria", lambda: MemorySystem(
+            store=SqliteMemoryStore(MEMORY_DB, legacy_path=MEMORY_FILE),
+            flush_interval=0, compartida=True
+        ))
+    else:
+        memory_system = medir_fase("memoria", MemorySystem)
+    client = medir_fase("cliente OpenAI", crear_cliente_openai)
+    logger.info(
+        "Arranque: inicialización en %.3f s (%.3f s desde el inicio del proceso)",
+        time.perf_counter() - inicio, time.perf_counter() - _INICIO_PROCESO
+    )
 
 # ─── EJECUCIÓN ────────────────────────────────────────────────────
-def main():
-    app = (
+async def al_iniciar(app: Application):
+    logger.info("Arranque: bot listo en %.3f s desde el inicio del proceso",
+                time.perf_counter() - _INICIO_PROCESO)
+    if CSV_POLL_INTERVAL > 0:
+        app.bot_data["vigilante_csv"] = asyncio.get_running_loop().create_task(vigilar_csv())
+    puerto = app.bot_data.get("puerto_metricas", METRICS_PORT)
+    if puerto:
+        app.bot_data["servidor_metricas"] = await asyncio.start_server(
+            atender_conexion_metricas, METRICS_LISTEN, puerto
+        )
+        logger.info("Métricas en http://%s:%d/metrics", METRICS_LISTEN, puerto)
+
+async def al_cerrar(app: Application):
+    vigilante = app.bot_data.pop("vigilante_csv", None)
+    if vigilante is not None:
+        vigilante.cancel()
+    servidor = app.bot_data.pop("servidor_metricas", None)
+    if servidor is not None:
+        servidor.close()
+    await extractor.detener()
+
+class ProcesadorPorUsuario(BaseUpdateProcessor):
+    """
+    Atiende hasta `concurrencia` actualizaciones a la vez, pero las de un mismo
+    usuario en el orden en que llegaron: cada una espera el candado de su
+    usuario antes de ocupar un lugar de ejecución, así una consulta lenta a la
+    IA no frena las búsquedas de los demás ni desordena los mensajes propios.
+    `max_pendientes` acota cuántas actualizaciones entran al procesador (en
+    curso o esperando el turno de su usuario). No limita la recepción: PTB crea
+    una tarea por cada actualización y las que exceden el límite esperan en el
+    semáforo de BaseUpdateProcessor.
+    """
+    def __init__(self, concurrencia=UPDATE_CONCURRENCY, max_pendientes=UPDATE_MAX_PENDING):
+        super().__init__(max(max_pendientes, concurrencia))
+        self.concurrencia = concurrencia
+        self._ejecutando = asyncio.Semaphore(concurrencia)
+        # user_id -> [candado, actualizaciones que lo usan]
+        self._candados = {}
+
+    @staticmethod
+    def clave_orden(update):
+        usuario = getattr(update, "effective_user", None)
+        if usuario is not None:
+            return usuario.id
+        chat = getattr(update, "effective_chat", None)
+        return chat.id if chat is not None else None
+
+    async def do_process_update(self, update, coroutine):
+        clave = self.clave_orden(update)
+        if clave is None:
+            async with self._ejecutando:
+                await coroutine
+            return
+        entrada = self._candados.setdefault(clave, [asyncio.Lock(), 0])
+        entrada[1] += 1
+        try:
+            async with entrada[0], self._ejecutando:
+                await coroutine
+        finally:
+            entrada[1] -= 1
+            if not entrada[1]:
+                del self._candados[clave]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def crear_aplicacion(con_updater=True) -> Application:
+    builder = (
         Application.builder()
         .token(TOKEN)
         .read_timeout(30)
         .write_timeout(30)
-        .build()
+        .post_init(al_iniciar)
+        .post_shutdown(al_cerrar)
     )
+    if UPDATE_CONCURRENCY > 1:
+        builder = builder.concurrent_updates(ProcesadorPorUsuario())
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    if not con_updater:
+        # En modo webhook las actualizaciones llegan por nuestro propio servidor HTTP
+        builder = builder.updater(None)
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("recargar", recargar))
+    app.add_handler(CommandHandler("stats", stats))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, buscar))
     app.add_handler(CallbackQueryHandler(callback_handler))
+    return app
+
+# ─── MODO WEBHOOK ─────────────────────────────────────────────────
+RAZONES_HTTP = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                405: "Method Not Allowed", 413: "Payload Too Large"}
+
+async def responder_http(writer, estado, cuerpo=b"", tipo="text/plain; charset=utf-8",
+                         mantener=True):
+    cabecera = (
+        f"HTTP/1.1 {estado} {RAZONES_HTTP.get(estado, '')}\r\n"
+        f"Content-Type: {tipo}\r\n"
+        f"Content-Length: {len(cuerpo)}\r\n"
+        f"Connection: {'keep-alive' if mantener else 'close'}\r\n\r\n"
+    )
+    writer.write(cabecera.encode("latin1") + cuerpo)
+    await writer.drain()
+
+MAX_CABECERAS_HTTP = 100
+
+async def leer_cabeceras_http(reader):
+    """(método, ruta, cabeceras) de la siguiente petición, o None al cerrarse la conexión."""
+    linea = await reader.readline()
+    if not linea.strip():
+        return None
+    metodo, ruta, _ = linea.decode("latin1").split(" ", 2)
+    cabeceras = {}
+    while True:
+        linea = await reader.readline()
+        if linea in (b"\r\n", b"\n", b""):
+            break
+        if len(cabeceras) >= MAX_CABECERAS_HTTP:
+            raise ValueError("demasiadas cabeceras")
+        nombre, _, valor = linea.decode("latin1").partition(":")
+        cabeceras[nombre.strip().lower()] = valor.strip()
+    return metodo, ruta.split("?", 1)[0], cabeceras
+
+def longitud_cuerpo(cabeceras) -> int:
+    longitud = int(cabeceras.get("content-length") or 0)
+    if longitud < 0:
+        raise ValueError("Content-Length negativo")
+    return longitud
+
+async def leer_peticion_http(reader):
+    """(método, ruta, cabeceras, cuerpo) de la siguiente petición, o None al cerrarse la conexión."""
+    peticion = await leer_cabeceras_http(reader)
+    if peticion is None:
+        return None
+    cuerpo = await reader.readexactly(longitud_cuerpo(peticion[2]))
+    return peticion + (cuerpo,)
+
+async def atender_conexion_webhook(reader, writer, app: Application):
+    """
+    Servidor HTTP/1.1 mínimo (con keep-alive) para los POST de Telegram:
+    valida ruta, secreto y tamaño con las cabeceras (antes de leer el cuerpo),
+    encola la actualización y responde 200 sin esperar a que se procese.
+    Una petición rechazada cierra la conexión sin leer su cuerpo.
+    """
+    try:
+        while True:
+            try:
+                peticion = await leer_cabeceras_http(reader)
+                if peticion is None:
+                    break
+                metodo, ruta, cabeceras = peticion
+                longitud = longitud_cuerpo(cabeceras)
+            except (ValueError, asyncio.IncompleteReadError):
+                await responder_http(writer, 400, mantener=False)
+                break
+            if ruta != WEBHOOK_PATH:
+                rechazo = 404
+            elif metodo != "POST":
+                rechazo = 405
+            elif WEBHOOK_SECRET and cabeceras.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+                rechazo = 403
+            elif longitud > WEBHOOK_MAX_BODY:
+                rechazo = 413
+            else:
+                rechazo = None
+            if rechazo:
+                await responder_http(writer, rechazo, mantener=False)
+                break
+            mantener = cabeceras.get("connection", "").lower() != "close"
+            try:
+                cuerpo = await reader.readexactly(longitud)
+            except asyncio.IncompleteReadError:
+                break
+            try:
+                update = Update.de_json(json.loads(cuerpo), app.bot)
+            except Exception as e:
+                logger.warning("Webhook: actualización inválida: %s", e)
+                await responder_http(writer, 400, mantener=mantener)
+            else:
+                await app.update_queue.put(update)
+                await responder_http(writer, 200, mantener=mantener)
+            if not mantener:
+                break
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+async def servir_webhook(sock, numero, memoria_compartida):
+    """Worker del webhook: su propia copia de los datos y su propia Application."""
+    inicializar(memoria_compartida=memoria_compartida)
+    app = crear_aplicacion(con_updater=False)
+    if METRICS_PORT:
+        # Métricas por proceso: cada worker en su propio puerto
+        app.bot_data["puerto_metricas"] = METRICS_PORT + numero
+    detener = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, detener.set)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    servidor = await asyncio.start_server(
+        lambda r, w: atender_conexion_webhook(r, w, app), sock=sock
+    )
+    logger.info("Webhook: worker %d (pid %d) atendiendo %s", numero, os.getpid(), WEBHOOK_PATH)
+    try:
+        await detener.wait()
+    finally:
+        servidor.close()
+        await servidor.wait_closed()
+        await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+        memory_system.close()
+
+def proceso_webhook(sock, numero, memoria_compartida):
+    asyncio.run(servir_webhook(sock, numero, memoria_compartida))
+
+async def registrar_webhook():
+    """Configura la URL pública del webhook en la API de Telegram."""
+    app = crear_aplicacion(con_updater=False)
+    async with app.bot as bot:
+        await bot.set_webhook(
+            url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+            max_connections=max(40, WEBHOOK_WORKERS * 10), allowed_updates=Update.ALL_TYPES
+        )
+    logger.info("Webhook registrado en %s", WEBHOOK_URL)
+
+def main_webhook():
+    """
+    Un solo socket de escucha compartido por WEBHOOK_WORKERS procesos; el
+    kernel reparte las conexiones entre ellos. Con más de un worker la memoria
+    de conversaciones se comparte a través de la base SQLite (MEMORY_DB).
+    Si un worker termina inesperadamente se arranca otro en su lugar.
+
+    El orden por usuario (ProcesadorPorUsuario), el límite de consultas
+    (LimitadorUsuarios), la caché de respuestas y las consultas compartidas son
+    por proceso: dos mensajes de un usuario que llegan a workers distintos
+    pueden atenderse a la vez, y cada worker aplica su propio límite.
+    """
+    if WEBHOOK_URL:
+        asyncio.run(registrar_webhook())
+    sock = socket.create_server((WEBHOOK_LISTEN, WEBHOOK_PORT), backlog=1024)
+    compartida = WEBHOOK_WORKERS > 1
+    if not compartida:
+        try:
+            proceso_webhook(sock, 0, False)
+        finally:
+            sock.close()
+        return
+
+    # Crea la base (y migra memory.json) una sola vez antes de arrancar los workers
+    SqliteMemoryStore(MEMORY_DB, legacy_path=MEMORY_FILE).close()
+    contexto = multiprocessing.get_context("spawn")
+
+    def arrancar(numero):
+        proceso = contexto.Process(target=proceso_webhook, args=(sock, numero, True),
+                                   name=f"webhook-{numero}")
+        proceso.start()
+        return proceso
+
+    terminando = False
+    def al_recibir_senal(signum, frame):
+        nonlocal terminando
+        terminando = True
+    signal.signal(signal.SIGTERM, al_recibir_senal)
+    signal.signal(signal.SIGINT, al_recibir_senal)
+
+    workers = {n: arrancar(n) for n in range(WEBHOOK_WORKERS)}
+    logger.info("Webhook: %d workers escuchando en %s:%d%s",
+                len(workers), WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        while not terminando:
+            multiprocessing.connection.wait([p.sentinel for p in workers.values()], timeout=1)
+            for numero, proceso in list(workers.items()):
+                if not proceso.is_alive() and not terminando:
+                    logger.error("Webhook: worker %d terminó (código %s); se reinicia",
+                                 numero, proceso.exitcode)
+                    time.sleep(1)
+                    workers[numero] = arrancar(numero)
+    finally:
+        for proceso in workers.values():
+            if proceso.is_alive():
+                proceso.terminate()
+        for proceso in workers.values():
+            proceso.join()
+        sock.close()
+
+def main():
+    if BOT_MODE == "webhook":
+        main_webhook()
+        return
+    inicializar()
+    app = crear_aplicacion()
 
     logger.info("Bot académico arrancado correctamente.")
-    app.run_polling()
+    try:
+        app.run_polling()
+    finally:
+        memory_system.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prueba de carga de punta a punta: reproduce tráfico de mensajes a través de la
+Application real del bot (handlers, procesador de actualizaciones, memoria,
+caché, IA) con servidores locales que imitan la Bot API de Telegram y la API
+de OpenAI, con latencia y tasa de error configurables.
+
+    python loadtest.py --usuarios 200 --mensajes 20
+    python loadtest.py --trafico mensajes.jsonl --ai-latencia 1.5 --ai-error 0.02
+
+El tráfico es un JSONL con un mensaje por línea: {"user": 7, "text": "23070045"}
+o {"user": 7, "callback": "grades|23070045"}. Se aceptan también "body"/"title"
+como texto; las líneas sin "user" se reparten entre --usuarios usuarios. Sin
+--trafico se genera una mezcla a partir del CSV.
+
+Reporta throughput, latencias por tipo de mensaje, retraso del event loop y
+llamadas a cada servicio falso.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+DIRECTORIO = tempfile.mkdtemp(prefix="loadtest_bot_")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# ─── SERVIDORES FALSOS ───────────────────────────────────────────
+class ServidorFalso:
+    """
+    Servidor HTTP en su propio hilo y event loop (para no competir con el bot)
+    que responde con `latencia` segundos (±50 %) y falla con probabilidad `error`.
+    """
+    def __init__(self, latencia=0.0, error=0.0, semilla=0):
+        self.latencia = latencia
+        self.error = error
+        self.rng = random.Random(semilla)
+        self.llamadas = Counter()
+        self.errores = Counter()
+        # El puerto se conoce antes de arrancar, para configurar el bot
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.puerto = self.sock.getsockname()[1]
+        self._listo = threading.Event()
+
+    def iniciar(self):
+        threading.Thread(target=lambda: asyncio.run(self._servir()), daemon=True).start()
+        self._listo.wait()
+        return self
+
+    async def _servir(self):
+        import bot
+        async def atender(reader, writer):
+            try:
+                while True:
+                    peticion = await bot.leer_peticion_http(reader)
+                    if peticion is None:
+                        break
+                    metodo, ruta, cabeceras, cuerpo = peticion
+                    if self.latencia:
+                        await asyncio.sleep(self.latencia * self.rng.uniform(0.5, 1.5))
+                    estado, tipo, respuesta = self.responder(ruta, cabeceras, cuerpo)
+                    await bot.responder_http(writer, estado, respuesta, tipo)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                writer.close()
+        servidor = await asyncio.start_server(atender, sock=self.sock)
+        self._listo.set()
+        async with servidor:
+            await servidor.serve_forever()
+
+    def falla(self, clave):
+        if self.error and self.rng.random() < self.error:
+            self.errores[clave] += 1
+            return True
+        return False
+
+class TelegramFalso(ServidorFalso):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.siguiente_id = 1
+
+    def responder(self, ruta, cabeceras, cuerpo):
+        metodo = ruta.rsplit("/", 1)[-1]
+        self.llamadas[metodo] += 1
+        if "json" in cabeceras.get("content-type", ""):
+            params = json.loads(cuerpo or b"{}")
+        else:
+            params = {k: v[0] for k, v in parse_qs(cuerpo.decode("utf-8")).items()}
+        if metodo != "getMe" and self.falla(metodo):
+            return 500, "application/json", json.dumps(
+                {"ok": False, "error_code": 500, "description": "Internal Server Error"}).encode()
+        if metodo == "getMe":
+            resultado = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "bot_prueba"}
+        elif metodo in ("sendMessage", "editMessageText"):
+            self.siguiente_id += 1
+            resultado = {
+                "message_id": int(params.get("message_id") or self.siguiente_id), "date": 0,
+                "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            resultado = True
+        return 200, "application/json", json.dumps({"ok": True, "result": resultado}).encode()
+
+class OpenAIFalso(ServidorFalso):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tokens = Counter()
+
+    def responder(self, ruta, cabeceras, cuerpo):
+        self.llamadas[ruta] += 1
+        if self.falla(ruta):
+            return 500, "application/json", json.dumps(
+                {"error": {"message": "error simulado", "type": "server_error"}}).encode()
+        peticion = json.loads(cuerpo)
+        contenido = "{}" if peticion.get("response_format") else (
+            "Según los datos, el rendimiento general es bueno: la mayoría de los alumnos "
+            "aprueba y el promedio ronda 8.5."
+        )
+        prompt, completado = len(cuerpo) // 4, len(contenido) // 4
+        self.tokens["prompt"] += prompt
+        self.tokens["completado"] += completado
+        usage = {"prompt_tokens": prompt, "completion_tokens": completado,
+                 "total_tokens": prompt + completado}
+        base = {"id": "chatcmpl-prueba", "created": 0, "model": peticion.get("model", "")}
+        if not peticion.get("stream"):
+            return 200, "application/json", json.dumps(dict(
+                base, object="chat.completion", usage=usage,
+                choices=[{"index": 0, "finish_reason": "stop",
+                          "message": {"role": "assistant", "content": contenido}}],
+            )).encode()
+        trozos = [
+            dict(base, object="chat.completion.chunk",
+                 choices=[{"index": 0, "delta": {"content": palabra + " "}, "finish_reason": None}])
+            for palabra in contenido.split()
+        ]
+        trozos.append(dict(base, object="chat.completion.chunk", choices=[], usage=usage))
+        sse = "".join(f"data: {json.dumps(t)}\n\n" for t in trozos) + "data: [DONE]\n\n"
+        return 200, "text/event-stream", sse.encode()
+
+# ─── TRÁFICO ─────────────────────────────────────────────────────
+def leer_trafico(path):
+    mensajes = []
+    with open(path, encoding="utf-8") as f:
+        for linea in f:
+            if not linea.strip():
+                continue
+            fila = json.loads(linea)
+            texto = fila.get("text") or fila.get("body") or fila.get("title")
+            if fila.get("callback"):
+                mensajes.append({"user": fila.get("user"), "callback": fila["callback"]})
+            elif texto:
+                mensajes.append({"user": fila.get("user"), "text": str(texto)})
+    return mensajes
+
+def generar_trafico(df, cantidad, rng):
+    """Mezcla parecida al uso real: sobre todo alumnos, algo de profesores e IA."""
+    alumnos = df.drop_duplicates("Matricula")
+    matriculas = alumnos["Matricula"].astype(str).tolist()
+    nombres = (alumnos["Nombre"].astype(str) + " " + alumnos["Paterno"].astype(str) + " "
+               + alumnos["Materno"].astype(str)).tolist()
+    profesores = df["Profesor"].dropna().astype(str).unique().tolist()
+    materias = df["Materia"].dropna().astype(str).unique().tolist()
+    preguntas = [
+        "¿Qué materias tienen más reprobados?", "¿Cómo va el rendimiento general?",
+        "¿Qué profesor tiene mejores promedios?", "Compara las carreras por promedio",
+    ]
+    tipos = [
+        (30, lambda: {"text": rng.choice(matriculas)}),
+        (15, lambda: {"text": rng.choice(nombres)}),
+        (15, lambda: {"callback": f"{rng.choice(['grades', 'general'])}|{rng.choice(matriculas)}"}),
+        (10, lambda: {"text": f"profesor {rng.choice(profesores)}"}),
+        (5, lambda: {"text": "lista de profesores"}),
+        (10, lambda: {"text": f"promedio de {rng.choice(materias)}"}),
+        (15, lambda: {"text": rng.choice(preguntas)}),
+    ]
+    pesos = [p for p, _ in tipos]
+    return [rng.choices(tipos, weights=pesos)[0][1]() for _ in range(cantidad)]
+
+def tipo_mensaje(mensaje):
+    if "callback" in mensaje:
+        return "callback"
+    texto = mensaje["text"].lower()
+    if texto.isdigit():
+        return "matricula"
+    if texto in ("profesores", "lista de profesores", "docentes"):
+        return "lista_profesores"
+    if texto.startswith(("profesor ", "docente ")):
+        return "profesor"
+    palabras = texto.split()
+    if 3 <= len(palabras) <= 6 and all(p.isalpha() for p in palabras) and palabras[0] != "promedio":
+        return "nombre"
+    return "consulta"
+
+def update_json(mensaje, user_id, update_id):
+    usuario = {"id": user_id, "is_bot": False, "first_name": f"Usuario{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    if "callback" in mensaje:
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": usuario, "chat_instance": str(user_id),
+            "data": mensaje["callback"],
+            "message": {"message_id": update_id, "date": 0, "chat": chat, "text": "..."},
+        }}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": chat, "from": usuario, "text": mensaje["text"],
+    }}
+
+# ─── MEDICIÓN ────────────────────────────────────────────────────
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+async def vigilar_event_loop(retrasos, intervalo=0.05):
+    """Retraso del event loop: cuánto se atrasa un sleep de `intervalo` segundos."""
+    while True:
+        inicio = time.perf_counter()
+        await asyncio.sleep(intervalo)
+        retrasos.append((time.perf_counter() - inicio - intervalo) * 1000)
+
+async def usuario(app, user_id, mensajes, pausa, latencias, contador):
+    from telegram import Update
+    for mensaje in mensajes:
+        update = Update.de_json(update_json(mensaje, user_id, next(contador)), app.bot)
+        inicio = time.perf_counter()
+        # Mismo camino que sigue la Application con cada actualización recibida
+        await app.update_processor.process_update(update, app.process_update(update))
+        latencias.setdefault(tipo_mensaje(mensaje), []).append((time.perf_counter() - inicio) * 1000)
+        if pausa:
+            await asyncio.sleep(pausa)
+
+async def correr(args, telegram, openai):
+    import bot
+    bot.inicializar()
+    if args.sin_limite:
+        bot.limitador.tasa = 0
+    app = bot.crear_aplicacion(con_updater=False)
+    errores = Counter()
+
+    async def contar_error(update, context):
+        errores[type(context.error).__name__] += 1
+    app.add_error_handler(contar_error)
+
+    rng = random.Random(args.semilla)
+    if args.trafico:
+        trafico = leer_trafico(args.trafico)
+    else:
+        trafico = generar_trafico(bot.datos.df, args.usuarios * args.mensajes, rng)
+    por_usuario = {}
+    sin_usuario = [m for m in trafico if m.get("user") is None]
+    for m in trafico:
+        if m.get("user") is not None:
+            por_usuario.setdefault(int(m["user"]), []).append(m)
+    for i, m in enumerate(sin_usuario * max(1, args.repetir)):
+        por_usuario.setdefault(1000 + i % args.usuarios, []).append(m)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    retrasos, latencias = [], {}
+    contador = iter(range(1, 10 ** 9))
+    monitor = asyncio.create_task(vigilar_event_loop(retrasos))
+    inicio = time.perf_counter()
+    await asyncio.gather(*(
+        usuario(app, user_id, mensajes, args.pausa, latencias, contador)
+        for user_id, mensajes in por_usuario.items()
+    ))
+    duracion = time.perf_counter() - inicio
+    monitor.cancel()
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
+    bot.memory_system.close()
+    return {
+        "usuarios": len(por_usuario),
+        "duracion": duracion,
+        "latencias": latencias,
+        "retrasos": retrasos,
+        "errores": errores,
+        "vuelo_compartidas": bot.vuelo_unico.compartidas,
+        "limitadas": bot.limitador.rechazadas,
+        "cache": bot.cache_respuestas.estadisticas(),
+    }
+
+def reportar(r, telegram, openai):
+    todas = [v for valores in r["latencias"].values() for v in valores]
+    print(f"\nUsuarios: {r['usuarios']} | Mensajes: {len(todas)} | Duración: {r['duracion']:.2f} s"
+          f" | Throughput: {len(todas) / r['duracion']:.1f} msg/s")
+    print(f"\n{'tipo':<18}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for tipo, valores in sorted(r["latencias"].items()) + [("TOTAL", todas)]:
+        print(f"{tipo:<18}{len(valores):>7}{percentil(valores, 50):>10.1f}{percentil(valores, 95):>10.1f}"
+              f"{percentil(valores, 99):>10.1f}{max(valores, default=0):>10.1f}")
+    retrasos = r["retrasos"]
+    print(f"\nRetraso del event loop: p50 {percentil(retrasos, 50):.1f} ms, "
+          f"p99 {percentil(retrasos, 99):.1f} ms, max {max(retrasos, default=0):.1f} ms")
+    print(f"Telegram: {dict(telegram.llamadas)} | errores simulados: {dict(telegram.errores)}")
+    print(f"OpenAI: {sum(openai.llamadas.values())} llamadas, errores simulados: "
+          f"{sum(openai.errores.values())}, tokens: {dict(openai.tokens)}")
+    print(f"Consultas IA compartidas: {r['vuelo_compartidas']} | limitadas: {r['limitadas']} | "
+          f"caché: {r['cache']}")
+    print(f"Errores en handlers: {dict(r['errores']) or 0}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del bot con servicios falsos")
+    parser.add_argument("--trafico", help="JSONL de mensajes a reproducir")
+    parser.add_argument("--csv", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      "detalle_calificaciones.csv"))
+    parser.add_argument("--usuarios", type=int, default=50)
+    parser.add_argument("--mensajes", type=int, default=20, help="Mensajes por usuario (tráfico generado)")
+    parser.add_argument("--repetir", type=int, default=1, help="Veces que se reproduce el JSONL")
+    parser.add_argument("--pausa", type=float, default=0.0, help="Segundos entre mensajes de un usuario")
+    parser.add_argument("--tg-latencia", type=float, default=0.05)
+    parser.add_argument("--tg-error", type=float, default=0.0)
+    parser.add_argument("--ai-latencia", type=float, default=0.8)
+    parser.add_argument("--ai-error", type=float, default=0.0)
+    parser.add_argument("--stream", action="store_true", help="Respuestas de IA en modo stream")
+    parser.add_argument("--sin-limite", action="store_true", help="Desactiva el límite por usuario")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+
+    telegram = TelegramFalso(args.tg_latencia, args.tg_error, args.semilla)
+    openai = OpenAIFalso(args.ai_latencia, args.ai_error, args.semilla + 1)
+    # La configuración del bot se lee al importarlo: antes de arrancar los servidores
+    os.environ.update({
+        "TELEGRAM_TOKEN": "0:prueba",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram.puerto}",
+        "OPENAI_API_KEY": "sk-prueba",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai.puerto}/v1",
+        "OPENAI_STREAM": "1" if args.stream else "0",
+        "CSV_PATH": args.csv,
+        "CSV_SNAPSHOT": "0",
+        "CSV_POLL_INTERVAL": "0",
+        "MEMORY_FILE": os.path.join(DIRECTORIO, "memory.json"),
+        "MEMORY_DB": os.path.join(DIRECTORIO, "memory.db"),
+    })
+    telegram.iniciar()
+    openai.iniciar()
+    logging.disable(logging.WARNING)
+    resultado = asyncio.run(correr(args, telegram, openai))
+    reportar(resultado, telegram, openai)
+
+if __name__ == "__main__":
+    main()
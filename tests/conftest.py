@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Las pruebas importan bot.py desde la raíz del repositorio sin escribir la
+# instantánea del CSV junto a los datos reales.
+os.environ.setdefault("CSV_SNAPSHOT", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
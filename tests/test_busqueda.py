@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+import bot
+
+CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                   "detalle_calificaciones.csv")
+
+
+@pytest.fixture(scope="module")
+def datos():
+    d = bot.cargar_datos(CSV)
+    assert not d.df.empty
+    return d
+
+
+def partir(texto):
+    """Misma división que `manejar_texto`: nombres, paterno y materno."""
+    partes = bot.quitar_acentos(texto).lower().split()
+    return " ".join(partes[:-2]), partes[-2], partes[-1]
+
+
+def busqueda_original(df, nombres, paterno, materno):
+    """El filtro secuencial con `str.contains` que reemplazó el índice."""
+    nombres_norm = df["Nombre"].astype(str).apply(lambda x: bot.quitar_acentos(x.lower()))
+    paternos_norm = df["Paterno"].astype(str).apply(lambda x: bot.quitar_acentos(x.lower()))
+    maternos_norm = df["Materno"].astype(str).apply(lambda x: bot.quitar_acentos(x.lower()))
+    mask = (
+        nombres_norm.str.contains(nombres, na=False) &
+        paternos_norm.str.contains(paterno, na=False) &
+        maternos_norm.str.contains(materno, na=False)
+    )
+    return df[mask]
+
+
+def primera_fila(sub):
+    return None if sub.empty else sub.index[0]
+
+
+def comparar(d, texto):
+    terminos = partir(texto)
+    esperado = busqueda_original(d.df, *terminos)
+    obtenido = d.buscar_por_nombre(*terminos)
+    assert primera_fila(obtenido) == primera_fila(esperado), texto
+
+
+@pytest.mark.parametrize("texto", [
+    # Nombre completo, con nombre de pila de una y de varias palabras
+    "ismael garcia alvarez",
+    "JOSE AARON CASTOR SALINAS",
+    "luis angel hernandez rocha",
+    # Nombres compuestos parciales: sólo el segundo nombre o un fragmento
+    "aaron castor salinas",
+    "angel hernandez rocha",
+    "luis hernandez rocha",
+    # Términos de menos de 3 letras (sin trigramas que intersectar)
+    "jo ca sa",
+    "luis he ro",
+    "a e o",
+    # Entrada con acentos y eñes contra datos sin acentos y viceversa
+    "José Aarón Castor Salinas",
+    "Jesús Eduardo Escobedo Briceño",
+    "jesus eduardo escobedo briceno",
+    # Sin coincidencias
+    "nadie inexistente tampoco",
+    "jose aaron castor rocha",
+])
+def test_busqueda_por_nombre_igual_a_la_original(datos, texto):
+    comparar(datos, texto)
+
+
+def test_busqueda_por_nombre_todos_los_alumnos(datos):
+    nombres = datos.df[["Nombre", "Paterno", "Materno"]].drop_duplicates()
+    for nombre, paterno, materno in nombres.itertuples(index=False):
+        comparar(datos, f"{nombre} {paterno} {materno}")
+        # Prefijos cortos de cada campo: muchos candidatos y sin trigramas
+        comparar(datos, f"{nombre[:2]} {paterno[:2]} {materno[:2]}")
+        comparar(datos, f"{nombre.split()[-1]} {paterno[:3]} {materno[-3:]}")
@@ -0,0 +1,152 @@
+import json
+import os
+
+import pytest
+
+import bot
+
+
+def mensaje(texto, role="user"):
+    return {"role": role, "content": texto, "timestamp": "2024-01-01T00:00:00"}
+
+
+@pytest.fixture
+def ruta(tmp_path):
+    return str(tmp_path / "memory.json")
+
+
+def abrir(ruta, compact_every=1000):
+    return bot.JsonMemoryStore(ruta, write_behind=True, compact_every=compact_every)
+
+
+def contenidos(store, user_id="1"):
+    return [m["content"] for m in store.load_conversation(user_id)]
+
+
+def lineas_diario(ruta):
+    with open(ruta + ".journal", encoding="utf-8") as f:
+        return [json.loads(linea) for linea in f]
+
+
+def test_recarga_aplica_el_diario(ruta):
+    store = abrir(ruta)
+    store.append_message(1, mensaje("hola"))
+    store.append_message(1, mensaje("adios"))
+    store.upsert_entity("alumnos", "123", {"nombre": "Ana"})
+    store.upsert_entity("alumnos", "123", {"promedio": 9})
+    store.flush()
+
+    assert not os.path.exists(ruta)
+    assert [e["seq"] for e in lineas_diario(ruta)] == [1, 2, 3, 4]
+
+    recargado = abrir(ruta)
+    assert contenidos(recargado) == ["hola", "adios"]
+    assert recargado.get_entity("alumnos", "123") == {"nombre": "Ana", "promedio": 9}
+    assert recargado.seq == 4
+    assert recargado.journal_entries == 4
+
+
+def test_sin_flush_solo_persiste_lo_ya_escrito(ruta):
+    store = abrir(ruta)
+    store.append_message(1, mensaje("escrito"))
+    store.flush()
+    store.append_message(1, mensaje("pendiente"))
+    store.upsert_entity("materias", "ETP-623", {"nombre": "Etica"})
+
+    recargado = abrir(ruta)
+    assert contenidos(recargado) == ["escrito"]
+    assert recargado.get_entity("materias", "ETP-623") == {}
+    assert recargado.seq == 1
+
+
+def test_linea_truncada_se_ignora_y_no_corrompe_lo_siguiente(ruta):
+    store = abrir(ruta)
+    store.append_message(1, mensaje("uno"))
+    store.append_message(1, mensaje("dos"))
+    store.flush()
+    # Caída a mitad de escribir la tercera línea
+    with open(ruta + ".journal", "a", encoding="utf-8") as f:
+        f.write('{"op": "conversation", "user_id": "1", "mess')
+
+    recargado = abrir(ruta)
+    assert contenidos(recargado) == ["uno", "dos"]
+    assert recargado.seq == 2
+
+    recargado.append_message(1, mensaje("tres"))
+    recargado.flush()
+    assert contenidos(abrir(ruta)) == ["uno", "dos", "tres"]
+
+
+def test_compactacion_reescribe_la_instantanea_y_vacia_el_diario(ruta):
+    store = abrir(ruta, compact_every=3)
+    store.append_message(1, mensaje("uno"))
+    store.append_message(2, mensaje("otro"))
+    store.flush()
+    assert not os.path.exists(ruta)
+
+    store.upsert_entity("profesores", "ALICIA MURILLO AVILA", {"materias": 1})
+    store.flush()
+    assert not os.path.exists(ruta + ".journal")
+    assert store.journal_entries == 0
+    with open(ruta, encoding="utf-8") as f:
+        instantanea = json.load(f)
+    assert instantanea["_journal_seq"] == 3
+    assert [m["content"] for m in instantanea["conversaciones"]["1"]] == ["uno"]
+
+    recargado = abrir(ruta, compact_every=3)
+    assert recargado.seq == 3
+    assert "_journal_seq" not in recargado.memory
+    assert contenidos(recargado, "2") == ["otro"]
+    assert recargado.get_entity("profesores", "ALICIA MURILLO AVILA") == {"materias": 1}
+
+
+def test_diario_anterior_a_la_instantanea_no_se_aplica_dos_veces(ruta):
+    store = abrir(ruta)
+    store.append_message(1, mensaje("uno"))
+    store.append_message(1, mensaje("dos"))
+    store.flush()
+    with open(ruta + ".journal", encoding="utf-8") as f:
+        diario = f.read()
+    # Caída entre reemplazar la instantánea y borrar el diario
+    store.save_memory()
+    with open(ruta + ".journal", "w", encoding="utf-8") as f:
+        f.write(diario)
+
+    recargado = abrir(ruta)
+    assert recargado.seq == 2
+    assert contenidos(recargado) == ["uno", "dos"]
+
+    # Las entradas nuevas continúan la secuencia y sí se aplican
+    recargado.append_message(1, mensaje("tres"))
+    recargado.flush()
+    assert lineas_diario(ruta)[-1]["seq"] == 3
+    assert contenidos(abrir(ruta)) == ["uno", "dos", "tres"]
+
+
+def test_lote_fallido_se_reintenta_en_orden(ruta, tmp_path):
+    store = abrir(ruta)
+    store.append_message(1, mensaje("uno"))
+    diario = store.journal_path
+    # Un directorio en lugar del diario hace fallar la escritura
+    store.journal_path = str(tmp_path)
+    store.flush()
+    assert len(store.reintentar) == 1
+    assert store.journal_entries == 0
+
+    store.journal_path = diario
+    store.append_message(1, mensaje("dos"))
+    store.flush()
+    assert store.reintentar == []
+    assert [e["seq"] for e in lineas_diario(ruta)] == [1, 2]
+    assert contenidos(abrir(ruta)) == ["uno", "dos"]
+
+
+def test_close_deja_solo_la_instantanea(ruta):
+    store = abrir(ruta)
+    store.append_message(1, mensaje("uno"))
+    store.close()
+    assert not os.path.exists(ruta + ".journal")
+
+    recargado = abrir(ruta)
+    assert contenidos(recargado) == ["uno"]
+    assert recargado.journal_entries == 0